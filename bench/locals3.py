@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""A minimal, in-memory stand-in for S3.
+
+Supports what mob needs: bucket HEAD and listing, single PUTs, multipart
+uploads (initiate, upload part, list parts, complete, abort) and (ranged)
+GETs. Requests are not authenticated. To make it useful for measurements,
+every request can be delayed, all request and response bodies share a
+bandwidth limit and uploads can be made to fail at random.
+
+Run ``python bench/locals3.py --help`` for options, statistics are available
+as JSON at ``/_stats``.
+"""
+
+import argparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import base64
+from hashlib import md5
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+from urllib import unquote
+import uuid
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ministryofbackup import byte_size
+from ministryofbackup.throttle import BandwidthSchedule, TokenBucket
+
+CHUNK_SIZE = 64 * 1024
+
+S3_NS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+
+class LocalS3Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0, bandwidth=None, fail_rate=0):
+        HTTPServer.__init__(self, address, LocalS3Handler)
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.token_bucket = TokenBucket(BandwidthSchedule(default=bandwidth))\
+                            if bandwidth else None
+
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.uploads = {}
+        self.stats = Stats()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    # helpers
+    def _parse(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path).lstrip('/').split('/', 1)
+        self.bucket_name = parts[0]
+        self.key_name = parts[1] if len(parts) > 1 else ''
+        self.query = dict((k, v[0]) for k, v in
+                          parse_qs(url.query, keep_blank_values=True).items())
+
+        self.server.stats.count('requests')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def _read_body(self):
+        remain = int(self.headers.getheader('content-length') or 0)
+        chunks = []
+        while remain:
+            chunk = self.rfile.read(min(CHUNK_SIZE, remain))
+            if not chunk:
+                break
+            if self.server.token_bucket:
+                self.server.token_bucket.consume(len(chunk))
+            chunks.append(chunk)
+            remain -= len(chunk)
+
+        body = ''.join(chunks)
+        self.server.stats.count('bytes_received', len(body))
+        return body
+
+    def _send(self, status, body='', headers={}):
+        self.send_response(status)
+        for k, v in headers.iteritems():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if 'HEAD' == self.command:
+            return
+
+        for i in xrange(0, len(body), CHUNK_SIZE):
+            chunk = body[i:i+CHUNK_SIZE]
+            if self.server.token_bucket:
+                self.server.token_bucket.consume(len(chunk))
+            self.wfile.write(chunk)
+        self.server.stats.count('bytes_sent', len(body))
+
+    def _send_xml(self, status, body):
+        self._send(status, '<?xml version="1.0" encoding="UTF-8"?>\n' + body,
+                   {'Content-Type': 'application/xml'})
+
+    def _error(self, status, code, message=''):
+        self.server.stats.count('errors')
+        self._send_xml(status, '<Error><Code>%s</Code><Message>%s</Message>'
+                               '</Error>' % (code, escape(message)))
+
+    def _inject_failure(self):
+        """Fail an upload request at random, either with an internal error or
+        by dropping the connection. The request body has been read."""
+        if random.random() >= self.server.fail_rate:
+            return False
+
+        self.server.stats.count('injected_failures')
+        if random.random() < 0.5:
+            self._error(500, 'InternalError', 'Injected failure')
+        else:
+            self.close_connection = 1
+        return True
+
+    def _get_bucket(self):
+        bucket = self.server.buckets.get(self.bucket_name)
+        if bucket is None:
+            self._error(404, 'NoSuchBucket', self.bucket_name)
+        return bucket
+
+    def _check_md5(self, body):
+        digest = md5(body)
+        content_md5 = self.headers.getheader('content-md5')
+        if content_md5 and base64.b64decode(content_md5) != digest.digest():
+            self._error(400, 'BadDigest')
+            return None
+        return '"%s"' % digest.hexdigest()
+
+    # handlers
+    def do_HEAD(self):
+        self._parse()
+        if '_stats' == self.bucket_name:
+            return self._send(200)
+
+        bucket = self._get_bucket()
+        if bucket is None:
+            return
+
+        if not self.key_name:
+            return self._send(200)
+
+        obj = bucket.get(self.key_name)
+        if obj is None:
+            return self._error(404, 'NoSuchKey', self.key_name)
+        self._send(200, obj['data'], {'ETag': obj['etag']})
+
+    def do_GET(self):
+        self._parse()
+        if '_stats' == self.bucket_name:
+            return self._send(200, json.dumps(self.server.stats.counts),
+                              {'Content-Type': 'application/json'})
+
+        bucket = self._get_bucket()
+        if bucket is None:
+            return
+
+        if not self.key_name:
+            return self._list(bucket)
+
+        if 'uploadId' in self.query:
+            return self._list_parts()
+
+        obj = bucket.get(self.key_name)
+        if obj is None:
+            return self._error(404, 'NoSuchKey', self.key_name)
+
+        data = obj['data']
+        m = re.match(r'bytes=(\d*)-(\d*)$', self.headers.getheader('range')
+                                            or '')
+        if not m:
+            return self._send(200, data, {'ETag': obj['etag']})
+
+        start, end = m.groups()
+        if not start:
+            start, end = len(data) - int(end), len(data) - 1
+        else:
+            start, end = int(start), int(end) if end else len(data) - 1
+        end = min(end, len(data) - 1)
+
+        if start > end:
+            return self._error(416, 'InvalidRange')
+
+        self._send(206, data[start:end+1], {
+            'ETag': obj['etag'],
+            'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data)),
+        })
+
+    def _list(self, bucket):
+        prefix = self.query.get('prefix', '')
+        marker = self.query.get('marker', '')
+        max_keys = int(self.query.get('max-keys', 1000))
+
+        names = sorted(k for k in bucket if k.startswith(prefix) and k > marker)
+        truncated = len(names) > max_keys
+        names = names[:max_keys]
+
+        contents = ''.join(
+            '<Contents><Key>%s</Key><Size>%d</Size><ETag>%s</ETag>'
+            '<LastModified>%s</LastModified>'
+            '<StorageClass>STANDARD</StorageClass></Contents>' % (
+                escape(k), len(bucket[k]['data']), escape(bucket[k]['etag']),
+                bucket[k]['modified']
+            ) for k in names)
+
+        self._send_xml(200,
+            '<ListBucketResult xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix>'
+            '<Marker>%s</Marker><MaxKeys>%d</MaxKeys>'
+            '<IsTruncated>%s</IsTruncated>%s</ListBucketResult>' % (
+                S3_NS, escape(self.bucket_name), escape(prefix),
+                escape(marker), max_keys, 'true' if truncated else 'false',
+                contents
+        ))
+
+    def _list_parts(self):
+        upload = self.server.uploads.get(self.query['uploadId'])
+        if upload is None:
+            return self._error(404, 'NoSuchUpload')
+
+        marker = int(self.query.get('part-number-marker') or 0)
+        max_parts = int(self.query.get('max-parts', 1000))
+
+        numbers = sorted(n for n in upload['parts'] if n > marker)
+        truncated = len(numbers) > max_parts
+        numbers = numbers[:max_parts]
+
+        parts = ''.join(
+            '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag>'
+            '<Size>%d</Size></Part>' % (
+                n, escape(upload['parts'][n][0]), len(upload['parts'][n][1])
+            ) for n in numbers)
+
+        self._send_xml(200,
+            '<ListPartsResult xmlns="%s"><Bucket>%s</Bucket><Key>%s</Key>'
+            '<UploadId>%s</UploadId><PartNumberMarker>%d</PartNumberMarker>'
+            '<NextPartNumberMarker>%d</NextPartNumberMarker>'
+            '<MaxParts>%d</MaxParts><IsTruncated>%s</IsTruncated>%s'
+            '</ListPartsResult>' % (
+                S3_NS, escape(self.bucket_name), escape(self.key_name),
+                self.query['uploadId'], marker,
+                numbers[-1] if numbers else marker, max_parts,
+                'true' if truncated else 'false', parts
+        ))
+
+    def do_PUT(self):
+        self._parse()
+        body = self._read_body()
+
+        if not self.key_name:
+            with self.server.lock:
+                self.server.buckets.setdefault(self.bucket_name, {})
+            return self._send(200)
+
+        bucket = self._get_bucket()
+        if bucket is None or self._inject_failure():
+            return
+
+        etag = self._check_md5(body)
+        if etag is None:
+            return
+
+        if 'uploadId' in self.query:
+            upload = self.server.uploads.get(self.query['uploadId'])
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+
+            self.server.stats.count('parts')
+            upload['parts'][int(self.query['partNumber'])] = (etag, body)
+        else:
+            self.server.stats.count('objects')
+            self._store(bucket, self.key_name, body, etag)
+
+        self._send(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        self._parse()
+        body = self._read_body()
+
+        bucket = self._get_bucket()
+        if bucket is None:
+            return
+
+        if 'uploads' in self.query:
+            upload_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.uploads[upload_id] = {
+                    'bucket': self.bucket_name,
+                    'key': self.key_name,
+                    'parts': {},
+                }
+            self.server.stats.count('uploads_initiated')
+
+            return self._send_xml(200,
+                '<InitiateMultipartUploadResult xmlns="%s"><Bucket>%s'
+                '</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                '</InitiateMultipartUploadResult>' % (
+                    S3_NS, escape(self.bucket_name), escape(self.key_name),
+                    upload_id
+            ))
+
+        if 'uploadId' in self.query:
+            with self.server.lock:
+                upload = self.server.uploads.pop(self.query['uploadId'], None)
+            if upload is None:
+                return self._error(404, 'NoSuchUpload')
+
+            requested = [(int(p.findtext('PartNumber')), p.findtext('ETag'))
+                         for p in ElementTree.fromstring(body).getiterator()
+                         if p.tag.endswith('Part')]
+
+            data = []
+            digests = []
+            for part_num, etag in requested:
+                stored = upload['parts'].get(part_num)
+                if stored is None or stored[0] != etag:
+                    return self._error(400, 'InvalidPart', str(part_num))
+                data.append(stored[1])
+                digests.append(stored[0].strip('"').decode('hex'))
+
+            etag = '"%s-%d"' % (md5(''.join(digests)).hexdigest(),
+                                len(digests))
+            self._store(bucket, self.key_name, ''.join(data), etag)
+            self.server.stats.count('uploads_completed')
+
+            return self._send_xml(200,
+                '<CompleteMultipartUploadResult xmlns="%s"><Location>%s/%s/%s'
+                '</Location><Bucket>%s</Bucket><Key>%s</Key><ETag>%s</ETag>'
+                '</CompleteMultipartUploadResult>' % (
+                    S3_NS, self.server.url, escape(self.bucket_name),
+                    escape(self.key_name), escape(self.bucket_name),
+                    escape(self.key_name), escape(etag)
+            ))
+
+        self._error(400, 'InvalidRequest')
+
+    def do_DELETE(self):
+        self._parse()
+
+        bucket = self._get_bucket()
+        if bucket is None:
+            return
+
+        if 'uploadId' in self.query:
+            with self.server.lock:
+                self.server.uploads.pop(self.query['uploadId'], None)
+            self.server.stats.count('uploads_aborted')
+        else:
+            with self.server.lock:
+                bucket.pop(self.key_name, None)
+
+        self._send(204)
+
+    def _store(self, bucket, key_name, data, etag):
+        with self.server.lock:
+            bucket[key_name] = {
+                'data': data,
+                'etag': etag,
+                'modified': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                          time.gmtime()),
+            }
+
+
+def serve(port=0, buckets=(), ready=None, **kwargs):
+    """Run a server until killed.
+
+    :param port: Port to listen on, 0 picks a free one.
+    :param buckets: Names of buckets to create.
+    :param ready: If given, a queue the actual port is put on once the
+                  server is listening.
+    :param kwargs: Passed on to :py:class:`LocalS3Server`.
+    """
+    server = LocalS3Server(('127.0.0.1', port), **kwargs)
+    for name in buckets:
+        server.buckets[name] = {}
+
+    if ready:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-p', '--port', type=int, default=9000)
+    parser.add_argument('-b', '--bucket', action='append', default=[],
+                        help='Create bucket on startup')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Delay every request by this many seconds')
+    parser.add_argument('--bandwidth', type=byte_size, default=None,
+                        help='Limit bandwidth to this many bytes per second')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='Fraction of uploads that fail')
+    args = parser.parse_args()
+
+    print 'Listening on http://127.0.0.1:%d' % args.port
+    serve(args.port, args.bucket, latency=args.latency,
+          bandwidth=args.bandwidth, fail_rate=args.fail_rate)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Benchmark the S3 upload path against a local S3 stand-in.
+
+Every combination of part size and pool size uploads the same random data
+through :py:class:`~ministryofbackup.backend.BotoBackend`, which is then
+downloaded again (as a whole and by range) to check it arrived intact.
+Reported are throughput, requests, injected failures and the peak memory
+usage of the upload processes.
+"""
+
+import argparse
+from hashlib import md5
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import urllib2
+
+import logbook
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ministryofbackup import byte_size
+from ministryofbackup.backend import BotoBackend
+from ministryofbackup.fds import FileDescriptorRegistry
+
+import locals3
+
+BUCKET = 'bench'
+WRITE_SIZE = 1024 ** 2
+
+
+def get_stats(port):
+    return json.load(urllib2.urlopen('http://127.0.0.1:%d/_stats' % port))
+
+
+def run_upload(port, data, part_size, pool_size, adaptive, results):
+    """Upload ``data`` once, runs in its own process so the memory usage of
+    the upload processes can be told apart."""
+    backend = BotoBackend('bench', 'bench', BUCKET,
+                          prefix='part%d-pool%d' % (part_size, pool_size),
+                          pool_size=pool_size,
+                          min_pool_size=1 if adaptive else pool_size,
+                          host='127.0.0.1',
+                          port=port,
+                          is_secure=False)
+    backend.MULTI_UPLOAD_MIN_FILE_SIZE = part_size
+
+    fdreg = FileDescriptorRegistry.get_global_instance()
+    start = time.time()
+    fd = backend.open_backup_archive('bench')
+    for i in xrange(0, len(data), WRITE_SIZE):
+        buf = data[i:i+WRITE_SIZE]
+        while buf:
+            buf = buf[os.write(fd, buf):]
+    fdreg.close(fd)
+
+    try:
+        backend.wait_for_completion()
+        error = None
+    except Exception, e:
+        error = str(e)
+    duration = time.time() - start
+
+    # check what arrived
+    ok = False
+    if not error:
+        key = backend._open_boto_bucket().get_key(
+            backend._key_name('bench.tar.xz.mob')
+        )
+        ok = md5(key.get_contents_as_string()).digest() == md5(data).digest()
+
+        a = random.randint(0, len(data) - 1)
+        b = random.randint(a, len(data) - 1)
+        ok = ok and data[a:b+1] == key.get_contents_as_string(
+            headers={'Range': 'bytes=%d-%d' % (a, b)}
+        )
+
+    results.put({
+        'duration': duration,
+        'error': error,
+        'ok': ok,
+        'maxrss': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-s', '--size', type=byte_size, default=64*1024**2,
+                        help='Amount of data to upload')
+    parser.add_argument('--part-sizes', default='5M,16M',
+                        help='Comma separated list of (initial) part sizes')
+    parser.add_argument('--pool-sizes', default='1,4,8',
+                        help='Comma separated list of upload pool sizes')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Let the upload window adapt, starting at one '
+                             'part, instead of using the full pool')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Delay every request by this many seconds')
+    parser.add_argument('--bandwidth', type=byte_size, default=None,
+                        help='Limit server bandwidth to this many bytes per '
+                             'second')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='Fraction of uploads that fail')
+    parser.add_argument('-d', '--debug', action='store_true')
+    args = parser.parse_args()
+
+    logbook.NullHandler().push_application()
+    logbook.StderrHandler(
+        level=logbook.DEBUG if args.debug else logbook.WARNING,
+        format_string='{record.channel}[{record.process}]: {record.message}'
+    ).push_application()
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=locals3.serve, kwargs={
+        'buckets': [BUCKET],
+        'ready': ready,
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'fail_rate': args.fail_rate,
+    })
+    server.daemon = True
+    server.start()
+    port = ready.get()
+
+    data = os.urandom(args.size)
+
+    print '%10s %5s %10s %8s %9s %8s %10s %4s' % (
+        'part size', 'pool', 'MB/s', 'seconds', 'requests', 'failures',
+        'max RSS MB', 'ok'
+    )
+    for part_size in map(byte_size, args.part_sizes.split(',')):
+        for pool_size in map(int, args.pool_sizes.split(',')):
+            before = get_stats(port)
+
+            results = multiprocessing.Queue()
+            p = multiprocessing.Process(target=run_upload, args=(
+                port, data, part_size, pool_size, args.adaptive, results
+            ))
+            p.start()
+            r = results.get()
+            p.join()
+
+            after = get_stats(port)
+            delta = dict((k, after.get(k, 0) - before.get(k, 0))
+                         for k in after)
+
+            print '%10d %5d %10.2f %8.2f %9d %8d %10.1f %4s' % (
+                part_size, pool_size,
+                args.size / r['duration'] / 1024 ** 2, r['duration'],
+                delta.get('requests', 0), delta.get('injected_failures', 0),
+                r['maxrss'] / 1024.0, 'yes' if r['ok'] else 'NO'
+            )
+            if r['error']:
+                print '    error: %s' % r['error']
+
+    server.terminate()
+
+
+if '__main__' == __name__:
+    main()
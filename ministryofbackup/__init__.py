@@ -2,6 +2,7 @@
 # coding=utf8
 
 from collections import namedtuple
+from contextlib import contextmanager
 from hashlib import sha1
 import mmap
 import os
@@ -9,22 +10,32 @@ import stat
 import sys
 import time
 from urllib import unquote
-from urlparse import urlparse
+from urlparse import urlparse, parse_qs
 import uuid
 
 import msgpack
 import logbook
-import progressbar
 from remember.memoize import memoize, memoized_property
 
-from backend import FilesystemBackend, BotoBackend
+from archive import create_input_chain, DEFAULT_BUFSIZE
+from backend import FilesystemBackend, BotoBackend, MultiBackend
+from changes import ChangeDetector
+from fds import FileDescriptorRegistry, data_extents
+from meta import MetaReader
 
 log = logbook.Logger(__name__)
 
-DATA_PROGRESS_BAR = ['Complete: ', progressbar.Percentage(), ' ',
-                        progressbar.Bar(marker='#', left='[', right=']'),
-                        ' ', progressbar.ETA(), ' ',
-                        progressbar.FileTransferSpeed()]
+def data_progress_bar(maxval):
+    """Create a progress bar for processing ``maxval`` bytes."""
+    import progressbar
+
+    return progressbar.ProgressBar(
+        widgets=['Complete: ', progressbar.Percentage(), ' ',
+                 progressbar.Bar(marker='#', left='[', right=']'),
+                 ' ', progressbar.ETA(), ' ',
+                 progressbar.FileTransferSpeed()],
+        maxval=maxval
+    )
 
 
 def backend_url(v):
@@ -43,21 +54,143 @@ def backend_url(v):
     return o
 
 
-def create_backend(urldata):
+def backend_name(urldata):
+    """Return a name for a backend url that is fit for logging, i.e.
+    without any credentials."""
+    return '%s://%s%s' % (urldata.scheme, urldata.hostname or '',
+                          urldata.path)
+
+
+SIZE_SUFFIXES = {'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4}
+DURATION_SUFFIXES = {'s': 1, 'm': 60, 'h': 60*60, 'd': 24*60*60}
+
+
+def _suffixed_value(v, suffixes):
+    number = v.strip().lower()
+    factor = 1
+    if number[-1:] in suffixes:
+        factor = suffixes[number[-1]]
+        number = number[:-1]
+
+    try:
+        value = float(number) * factor
+    except ValueError:
+        raise ValueError('Not a valid value: %s' % v)
+
+    if value <= 0:
+        raise ValueError('Value must be positive: %s' % v)
+
+    return value
+
+
+def byte_size(v):
+    """Parse a size like ``500M`` or ``2.5T`` into a number of bytes."""
+    return int(_suffixed_value(v, SIZE_SUFFIXES))
+
+
+def duration(v):
+    """Parse a duration like ``90m`` or ``8h`` into a number of seconds."""
+    return _suffixed_value(v, DURATION_SUFFIXES)
+
+
+def create_backend(urldata, pool_size=6, min_pool_size=1, bandwidth=None,
+                   sync_interval=64*1024**2, sync=True):
+    """Create a backend from a parsed url.
+
+    :param urldata: Result of :py:func:`backend_url`.
+    :param pool_size: Maximum number of parallel uploads.
+    :param min_pool_size: Minimum number of parallel uploads.
+    :param bandwidth: A :py:class:`~ministryofbackup.throttle.BandwidthSchedule`
+                      to limit upload bandwidth.
+    :param sync_interval: For local storage, flush data to disk after this
+                          many bytes.
+    :param sync: If ``False``, never wait for local storage to reach the
+                 disk.
+    """
     if 'file' == urldata.scheme:
-        return FilesystemBackend(urldata.path)
+        return FilesystemBackend(urldata.path,
+                                 sync_interval=sync_interval,
+                                 sync=sync)
     elif 's3' == urldata.scheme:
         pw = unquote(urldata.password or '')
         #log.debug('S3 secret key: %s' % pw)
+
+        # a different endpoint can be given as ?host=HOST[:PORT][&secure=no]
+        query = dict((k, v[-1]) for k, v in parse_qs(urldata.query).items())
+        host, port = query.get('host'), None
+        if host and ':' in host:
+            host, port = host.rsplit(':', 1)
+            port = int(port)
+
         return BotoBackend(
             access_key=unquote(urldata.username),
             secret_key=unquote(pw),
             bucket_name=unquote(urldata.hostname),
-            prefix=unquote(urldata.path)
+            prefix=unquote(urldata.path),
+            pool_size=pool_size,
+            min_pool_size=min_pool_size,
+            bandwidth=bandwidth,
+            host=host,
+            port=port,
+            is_secure=query.get('secure', 'yes').lower() not in ('no', '0',
+                                                                  'false'),
         )
 
 
+def create_backends(urls, buffer_size=64*1024**2, **kwargs):
+    """Create a backend storing on all of ``urls`` at once.
+
+    :param urls: List of results of :py:func:`backend_url`.
+    :param buffer_size: With more than one url, bytes buffered for each
+                        backend before the faster ones wait for it.
+    :param kwargs: Passed on to :py:func:`create_backend`.
+    """
+    if 1 == len(urls):
+        return create_backend(urls[0], **kwargs)
+
+    return MultiBackend([(backend_name(u), create_backend(u, **kwargs))
+                         for u in urls], buffer_size=buffer_size)
+
+
+@contextmanager
+def open_backup_meta(backend, backup_id, password, bufsize=DEFAULT_BUFSIZE):
+    """Retrieve and decrypt the meta archive of a backup, for reading it
+    lazily.
+
+    :param backend: Backend the backup is stored on.
+    :param backup_id: Id of the backup.
+    :param password: Password the backup was encrypted with.
+    :return: A context manager for a
+             :py:class:`~ministryofbackup.meta.MetaReader`.
+    """
+    fdreg = FileDescriptorRegistry.get_global_instance()
+
+    srcfd = backend.open_backup_meta_read(backup_id)
+    fdreg.add_fd(srcfd)
+    meta_r, meta_w = fdreg.pipe()
+    ps = create_input_chain(fdreg, srcfd, meta_w, password, bufsize)
+
+    # only the decrypting and decompressing processes need the rest
+    fdreg.close_all_except([meta_r])
+
+    with os.fdopen(meta_r, 'rb') as m:
+        try:
+            yield MetaReader(m)
+        finally:
+            # whatever was not read, the processes still want to get rid of
+            while m.read(bufsize):
+                pass
+    fdreg.remove_fd(meta_r)
+
+    for p in ps:
+        p.join()
+    backend.wait_for_completion()
+
+
 class HashReadWrap(object):
+    # reads the whole file, see SparseReadWrap
+    extents = None
+
     def __init__(self, fileobj, hashfunc=sha1):
         self.h = hashfunc()
         self.fileobj = fileobj
@@ -80,6 +213,69 @@ class HashReadWrap(object):
         return self.fileobj.closed
 
 
+# holes are hashed from this instead of reading them
+_ZEROS = '\0' * (1024*1024)
+
+
+class SparseReadWrap(HashReadWrap):
+    """Reads only the data extents of a sparse file, one after the other.
+
+    The hash is still that of the complete contents, holes are hashed as the
+    zeros they read as without reading them.
+
+    :param extents: The data extents of the file, see
+                    :py:func:`~ministryofbackup.fds.data_extents`.
+    :param size: Size of the file.
+    """
+
+    def __init__(self, fileobj, extents, size, hashfunc=sha1):
+        super(SparseReadWrap, self).__init__(fileobj, hashfunc)
+        self.extents = extents
+        self.size = size
+        self._pending = list(reversed(extents))
+        self._pos = 0
+
+    def read(self, size=-1):
+        # like a plain file, only return less than requested at the end
+        bufs = []
+        while self._pending and size:
+            offset, length = self._pending[-1]
+            if self._pos < offset:
+                self._hash_zeros(offset - self._pos)
+                self._pos = offset
+                self.fileobj.seek(offset)
+
+            remain = offset + length - self._pos
+            if not remain:
+                self._pending.pop()
+                continue
+
+            buf = self.fileobj.read(remain if size < 0 else min(size,
+                                                                   remain))
+            if not buf:
+                self._pending = []
+                break
+            self._pos += len(buf)
+            self.h.update(buf)
+            bufs.append(buf)
+            if size > 0:
+                size -= len(buf)
+
+        if bufs:
+            return ''.join(bufs)
+
+        if not self.eofreached:
+            self._hash_zeros(self.size - self._pos)
+            self._pos = self.size
+            self.eofreached = True
+        return ''
+
+    def _hash_zeros(self, n):
+        while n > 0:
+            self.h.update(_ZEROS if n >= len(_ZEROS) else _ZEROS[:n])
+            n -= len(_ZEROS)
+
+
 class MetaBase(object):
     """An object representing the metadata of an entity on the filesystem.
 
@@ -106,10 +302,23 @@ class FileMeta(MetaBase):
     read_buf_size = 1024*1024*4  # 4M should be sufficient for speed and not
                                  # too memory hungry
 
+    # for hardlinks, the FileMeta of the first link found to the same inode
+    primary = None
+
+    # decides which stat fields make up the meta print
+    change_detector = ChangeDetector()
+
     @memoized_property
     def content_print(self):
         """Content prints rely only on the contents of the file - pretty much a
         'normal' application of the underlying hash function"""
+        if hasattr(self, '_known_content_print'):
+            return self._known_content_print
+
+        # all links share their contents, only one of them is read
+        if self.primary is not None:
+            return self.primary.content_print
+
         if hasattr(self, '_fileobj'):
             if self._fileobj.eofreached:
                 return self._fileobj.h.digest()
@@ -126,6 +335,13 @@ class FileMeta(MetaBase):
             remain = self.filesize
 
             with open(self.path, 'rb') as src:
+                extents = self.data_extents(src)
+                if extents is not None:
+                    r = SparseReadWrap(src, extents, self.filesize)
+                    while r.read(self.read_buf_size):
+                        pass
+                    return r.h.digest()
+
                 buf = True
                 while remain:
                     buf = src.read(min(self.read_buf_size, remain))
@@ -145,9 +361,7 @@ class FileMeta(MetaBase):
     def meta_print(self):
         """The meta print is a fingerprint based solely on the metadata of the
         file, not the contents"""
-
-        stat_string = ' '.join(map(str, iter(self.s)))
-        return sha1(stat_string).digest()
+        return self.change_detector.meta_print(self.s)
 
     @memoized_property
     def meta_tuple(self):
@@ -161,8 +375,38 @@ class FileMeta(MetaBase):
             ctime=self.s.st_ctime,
         )
 
+    def remember_content_print(self, digest):
+        """Use a content print that was calculated elsewhere (e.g. by the
+        process that archived the file) instead of reading the file again."""
+        self._known_content_print = digest
+
+    def data_extents(self, fileobj):
+        """Return the data extents of a file with holes, ``None`` for all
+        others.
+
+        :param fileobj: The file, opened for reading.
+        """
+        # files without holes have all their blocks allocated, most are ruled
+        # out without asking the filesystem
+        if self.s.st_blocks * 512 >= self.filesize:
+            return None
+
+        extents = data_extents(fileobj.fileno(), self.filesize)
+        if extents is None or\
+           sum(length for offset, length in extents) == self.filesize:
+            return None
+        return extents
+
     def open_read(self):
-        self._fileobj = HashReadWrap(open(self.path, 'rb'), sha1)
+        """Open the file for reading, hashing its contents on the way. For
+        files with holes, only the data extents (``extents`` of the returned
+        object) are read."""
+        f = open(self.path, 'rb')
+        extents = self.data_extents(f)
+        if extents is None:
+            self._fileobj = HashReadWrap(f, sha1)
+        else:
+            self._fileobj = SparseReadWrap(f, extents, self.filesize, sha1)
 
         return self._fileobj
 
@@ -180,13 +424,22 @@ class Database(object):
     A database keeps relative paths only. The folder being upload can therefore
     be moved elsewhere.
 
+    If ``journal`` is set to a :py:class:`~ministryofbackup.journal.Journal`,
+    content prints are recorded in it as files are checked for alterations,
+    and scans reuse those recorded by earlier, interrupted runs.
+
     :param base: The base path for the folder to be backed up. **Must** be an
                  absolute path.
+    :param detector: The :py:class:`~ministryofbackup.changes.ChangeDetector`
+                     creating meta prints.
     """
-    def __init__(self, base):
+    def __init__(self, base, detector=None):
         self.base = base
+        self.detector = detector or ChangeDetector()
         self.meta_prints = {}
         self.content_prints = {}
+        self.links = {}
+        self.journal = None
         self.series_id = str(uuid.uuid4())
 
     def dump(self, outfile):
@@ -195,6 +448,7 @@ class Database(object):
             'meta_prints': self.meta_prints,
             'content_prints': self.content_prints,
             'series_id': self.series_id,
+            'change_fields': list(self.detector.fields),
         }
         msgpack.dump(db_dict, outfile)
 
@@ -216,13 +470,11 @@ class Database(object):
 
         n_bytes = 0
         for rel_name in fileset:
-            f = self.files[rel_name]
-            if rel_name in self.content_prints:
-                if f.content_print != self.content_prints[rel_name]:
-                    altered.append(rel_name)
+            if self.is_altered(rel_name):
+                altered.append(rel_name)
 
             if progress:
-                n_bytes += f.filesize
+                n_bytes += self.files[rel_name].filesize
                 progress(n_bytes)
 
         return altered
@@ -256,10 +508,9 @@ class Database(object):
                 progress(n_files)
                 n_files += 1
 
-            if not rel_name in self.meta_prints:
+            if self.is_new(rel_name):
                 new.append(rel_name)
-                continue
-            if self.meta_prints[rel_name] != file_meta.meta_print:
+            elif self.is_updated(rel_name):
                 updated.append(rel_name)
 
         return new, updated
@@ -277,56 +528,169 @@ class Database(object):
 
         return sum(self.files[rel_name].filesize for rel_name in fileset)
 
+    def is_altered(self, rel_name):
+        """Check whether the contents of a known file have changed. This
+        requires reading the whole file.
+
+        :param rel_name: Relative name of a file found on the filesystem.
+        """
+        if not rel_name in self.content_prints:
+            return False
+
+        f_meta = self.files[rel_name]
+        if self.journal is not None:
+            self.journal.add(rel_name, f_meta.meta_print,
+                             f_meta.content_print)
+        return f_meta.content_print != self.content_prints[rel_name]
+
+    def is_new(self, rel_name):
+        """Check whether a file found on the filesystem has no record."""
+        return not rel_name in self.meta_prints
+
+    def is_updated(self, rel_name):
+        """Check whether a known file has new metadata (stat)."""
+        return rel_name in self.meta_prints and\
+               self.meta_prints[rel_name] != self.files[rel_name].meta_print
+
     @classmethod
-    def load(cls, base, infile):
+    def load(cls, base, infile, detector=None):
         """Unserialize a database from file.
 
+        Meta prints stored using other fields than those of ``detector`` are
+        converted if possible. Otherwise, all files are checked for altered
+        contents once.
+
         :param base: Base path that all files are supposedly relative to.
         :param infile: File object to read from.
+        :param detector: See :py:class:`Database`.
 
         :return: A :py:class:Database instance.
         """
         db_dict = msgpack.load(infile)
 
-        db = cls(base)
+        db = cls(base, detector)
         db.meta_prints = db_dict['meta_prints']
+
+        # databases of older versions hold hashes of all stat fields
+        stored = ChangeDetector(db_dict['change_fields'])\
+                 if 'change_fields' in db_dict else None
+        convert = db.detector.converter(stored) if stored else None
+        if convert is None:
+            log.notice('Database was made using other change detection '
+                       'fields, all files with records are read once')
+        elif stored != db.detector:
+            db.meta_prints = dict((rel_name, convert(meta_print))
+                                  for rel_name, meta_print
+                                  in db.meta_prints.iteritems())
         db.content_prints = db_dict['content_prints']
         db.series_id = db_dict['series_id']
 
         return db
 
+    @staticmethod
+    def read_series_id(infile):
+        """Read only the series id of a serialized database, skipping the
+        records.
+
+        :param infile: File object to read from.
+        """
+        unpacker = msgpack.Unpacker(infile)
+        for i in xrange(unpacker.read_map_header()):
+            if 'series_id' == unpacker.unpack():
+                return unpacker.unpack()
+            unpacker.skip()
+
     def load_meta(self):
         """Loads all metadata (lstats) from the filesystem.
 
         This should be called once for every database, after creating it and
         before doing anything further with it.
         """
-        files = {}
-        dirs = {}
+        for rel_name, f_meta in self.scan():
+            pass
+
+    def scan(self):
+        """Like :py:meth:`load_meta`, but yields files while the filesystem is
+        still being walked, allowing them to be processed right away.
+
+        Hardlinks are grouped by inode: the first link found is yielded first
+        and all others are recorded in ``links``.
+
+        :return: A generator of ``(rel_name, file_meta)`` tuples.
+        """
+        self.files = {}
+        self.dirs = {}
+        self.links = {}
+        inodes = {}
 
         for root, ds, fs in os.walk(self.base):
             rel_root = root[len(self.base)+1:]
             root_meta = DirMeta(root)
+            self.dirs[rel_root] = root_meta
 
             for f in fs:
                 full_name = os.path.join(root, f)
                 rel_name = full_name[len(self.base)+1:]
                 f_meta = FileMeta(full_name)
-                files[rel_name] = f_meta
+                f_meta.change_detector = self.detector
+                self.files[rel_name] = f_meta
                 root_meta.children.append(f_meta)
 
-            dirs[rel_root] = root_meta
-
-        self.files = files
-        self.dirs = dirs
+                # reuse what an interrupted run found out
+                if self.journal is not None and\
+                   rel_name in self.journal.entries:
+                    content_print = self.journal.lookup(rel_name,
+                                                        f_meta.meta_print)
+                    if content_print is not None:
+                        f_meta.remember_content_print(content_print)
+
+                if f_meta.s.st_nlink > 1 and stat.S_ISREG(f_meta.s.st_mode):
+                    inode = (f_meta.s.st_dev, f_meta.s.st_ino)
+                    if inode in inodes:
+                        self.links[rel_name] = inodes[inode]
+                        f_meta.primary = self.files[inodes[inode]]
+                    else:
+                        inodes[inode] = rel_name
+
+                yield rel_name, f_meta
+
+    def relink(self, group, primary):
+        """Make another link the first one of its inode, in place of the one
+        found first by :py:meth:`scan`.
+
+        :param group: Relative names of all links to the inode.
+        :param primary: Relative name of the new first link.
+        """
+        for rel_name in group:
+            f_meta = self.files[rel_name]
+            if rel_name == primary:
+                self.links.pop(rel_name, None)
+                f_meta.primary = None
+            else:
+                self.links[rel_name] = primary
+                f_meta.primary = self.files[primary]
 
-    def update_meta(self):
+    def update_meta(self, skip=None):
         """Replace the stored metadata with up-to-date info from the
-        filesystem."""
+        filesystem.
+
+        :param skip: Relative names of files that were not backed up in this
+                     run. These keep their previous record (or remain
+                     unknown, if they are new), so the next run picks them
+                     up again.
+        """
+        skip = set(skip or [])
 
         new_meta_prints = {}
         new_content_prints = {}
         for rel_name, file_meta in self.files.iteritems():
+            if rel_name in skip:
+                if rel_name in self.meta_prints:
+                    new_meta_prints[rel_name] = self.meta_prints[rel_name]
+                    new_content_prints[rel_name] =\
+                        self.content_prints[rel_name]
+                continue
+
             new_meta_prints[rel_name] = file_meta.meta_print
 
             # if the metadata's the same, assume content hasn't changed either
@@ -9,10 +9,13 @@ import os
 
 import logbook
 from lzma import LZMACompressor, LZMADecompressor
-import M2Crypto
-from M2Crypto.m2 import AES_BLOCK_SIZE
 from setproctitle import setproctitle
 
+from limits import CPU, slot
+
+# M2Crypto is slow to import, the encryption and decryption processes import
+# it themselves
+
 log = logbook.Logger(__name__)
 
 # the mob header, currently uses the form of 'mobX', where X is the file format
@@ -38,6 +41,9 @@ DEFAULT_BUFSIZE = 4*1024**2
 # random number generator
 RNG = os.urandom
 
+# same as M2Crypto.m2.AES_BLOCK_SIZE, which would require importing M2Crypto
+AES_BLOCK_SIZE = 16
+
 
 def compress(srcfd, destfd, level=9, bufsize=DEFAULT_BUFSIZE):
     setproctitle('mob compression')
@@ -55,7 +61,9 @@ def compress(srcfd, destfd, level=9, bufsize=DEFAULT_BUFSIZE):
 
         if not buf:
             break
-        dest.write(compressor.compress(buf))
+        with slot(CPU):
+            data = compressor.compress(buf)
+        dest.write(data)
 
     # clean up
     dest.write(compressor.flush())
@@ -81,6 +89,8 @@ def decompress(srcfd, destfd, bufsize=DEFAULT_BUFSIZE):
 
 
 def encrypt(srcfd, destfd, password, bufsize=DEFAULT_BUFSIZE):
+    import M2Crypto
+
     log.debug("Starting encryption in process %d" % os.getpid())
     setproctitle('mob encryption')
     salt = RNG(SALT_LEN)
@@ -110,7 +120,8 @@ def encrypt(srcfd, destfd, password, bufsize=DEFAULT_BUFSIZE):
         if not buf:
             break
         log.debug("Encrypting %d bytes" % len(buf))
-        data = aes.update(buf)
+        with slot(CPU):
+            data = aes.update(buf)
         dest.write(data)
 
     dest.write(aes.final())
@@ -118,6 +129,8 @@ def encrypt(srcfd, destfd, password, bufsize=DEFAULT_BUFSIZE):
 
 
 def decrypt(srcfd, destfd, password, bufsize=DEFAULT_BUFSIZE):
+    import M2Crypto
+
     src = os.fdopen(srcfd, 'rb')
     dest = os.fdopen(destfd, 'wb')
 
@@ -1,136 +1,494 @@
 #!/usr/bin/env python
 # coding=utf8
 
+from base64 import b64encode
+import atexit
+from binascii import hexlify, unhexlify
 from cStringIO import StringIO
+import errno
+from hashlib import md5, sha256
 import multiprocessing
 import os
+from Queue import Empty, Queue
+import sys
+from threading import Event, Thread
+import time
 
-from boto.s3.connection import S3Connection
-from boto.s3.key import Key
-from boto.exception import AWSConnectionError
 import logbook
 from setproctitle import setproctitle
 
-from fds import FileDescriptorRegistry
+from fds import FileDescriptorRegistry, fallocate
+from limits import UPLOAD, shared_bucket, slot
+from profiling import profiled, stage_name
+from throttle import AIMDController, ThrottledReader, TokenBucket
+
+# boto is slow to import, BotoBackend imports it where needed
 
 log = logbook.Logger('backend')
 
 ARCHIVE_ENDING = '.tar.xz.mob'
 META_ENDING = '.mdx.xz.mob'
 
-class FilesystemBackend(object):
-    def __init__(self, basepath):
+class Backend(object):
+    """Base class for backends that store data in background processes.
+
+    Backends hand out file descriptors to write to, the data written is
+    picked up by a process started for each of them, unless the backend can
+    store it without one.
+    """
+
+    # whether background processes are daemonic, i.e. killed when mob exits
+    daemonic_tasks = True
+
+    def __init__(self):
+        self.running_tasks = []
+
+    def list_backups(self):
+        """Return the ids of all backups with a stored meta archive, sorted
+        by id (which orders the backups of a series by age)."""
+        return sorted(name[:-len(META_ENDING)] for name in self.list_archives()
+                      if name.endswith(META_ENDING))
+
+    def wait_for_completion(self):
+        """Wait for all background processes to finish.
+
+        :return: A dictionary of the manifests of all files stored since the
+                 last call, by name. A manifest holds at least the ``size`` of
+                 the stored file.
+        """
+        manifests = {}
+        while self.running_tasks:
+            task, conn, name, for_reading = self.running_tasks.pop(0)
+
+            # the only write end is in the task, so this returns once the
+            # task is done
+            try:
+                result = conn.recv()
+            except EOFError:
+                result = None
+            conn.close()
+            task.join()
+
+            if task.exitcode:
+                raise Exception('Storage process %d failed (exit code %d)' % (
+                    task.pid, task.exitcode
+                ))
+
+            if result is not None:
+                manifests[name] = result
+
+        return manifests
+
+    def abort(self):
+        """Give up on all files opened since the last call, removing what
+        was stored of them. Everything writing to them must have finished.
+        """
+        while self.running_tasks:
+            task, conn, name, for_reading = self.running_tasks.pop(0)
+            # the task ends once its input does, whether it fails or not
+            conn.close()
+            task.join()
+
+            if not for_reading:
+                self._remove(name)
+                log.debug('Removed %s' % name)
+
+    def _remove(self, name):
+        """Remove a stored file, if it exists."""
+        raise NotImplementedError
+
+    def _create_task_process(self, target, name, for_reading=False,
+                             keep_fds=(), **kwargs):
+        """Start ``target`` in a background process, connected to the caller
+        through a pipe. The return value of ``target`` is returned by
+        :py:meth:`wait_for_completion`.
+
+        :param name: Name of the file handled by the task.
+        :param for_reading: If ``True``, the caller reads from the pipe,
+                            otherwise it writes to it.
+        :param keep_fds: Further file descriptors the task needs.
+        :return: The callers end of the pipe.
+        """
+        fdreg = FileDescriptorRegistry.get_global_instance()
+        pipe_r, pipe_w = fdreg.pipe()
+        task_fd, caller_fd = (pipe_w, pipe_r) if for_reading\
+                             else (pipe_r, pipe_w)
+        kwargs['fd'] = task_fd
+
+        result_r, result_w = multiprocessing.Pipe(duplex=False)
+        task = multiprocessing.Process(
+            target=fdreg.closing_all_except([task_fd] + list(keep_fds))(
+                self._run_task
+            ),
+            args=(result_w, target),
+            kwargs=kwargs
+        )
+        task.daemon = self.daemonic_tasks
+        task.start()
+
+        result_w.close()
+        fdreg.close(task_fd)
+
+        log.debug('Started storage background process, pid %d' % task.pid)
+
+        self.running_tasks.append((task, result_r, name, for_reading))
+
+        return caller_fd
+
+    def _run_task(self, conn, target, **kwargs):
+        conn.send(profiled(stage_name(target))(target)(**kwargs))
+        conn.close()
+
+
+class StoredFile(object):
+    """A file of a :py:class:`FilesystemBackend` while it is being written.
+
+    The last stage of the pipeline writes to a temporary file directly. In
+    the meantime, a thread watches the file grow, preallocating disk space
+    ahead of it in steps and flushing data to disk every ``sync_interval``
+    bytes. Once finished, space not needed is released and the file is
+    renamed, so an archive is either complete or not there at all.
+    """
+
+    # seconds between checks of the size of the file
+    POLL_INTERVAL = 0.1
+
+    # space is preallocated in steps, starting with the minimum step and
+    # growing with the file, up to the maximum step
+    MIN_PREALLOCATION = 64 * 1024 ** 2
+    MAX_PREALLOCATION = 1024 ** 3
+
+    def __init__(self, fn, sync_interval, sync):
+        self.fn = fn
+        self.tmp_fn = os.path.join(os.path.dirname(fn),
+                                   '.%s.tmp' % os.path.basename(fn))
+        self.sync_interval = sync_interval
+        self.sync = sync
+
+        self.fd = os.open(self.tmp_fn, os.O_CREAT | os.O_WRONLY | os.O_EXCL,
+                          0666)
+        self.n_allocated = 0
+        self.n_synced = 0
+        self.preallocate = True
+        self._allocate(0)
+
+        self._done = Event()
+        self._watcher = Thread(target=self._watch)
+        self._watcher.daemon = True
+        self._watcher.start()
+        # a run that fails leaves the file unfinished, the watcher must not
+        # outlive the modules it uses
+        atexit.register(self._stop)
+
+    def finish(self):
+        """Complete the file, once nothing is writing to it anymore.
+
+        :return: The manifest of the file.
+        """
+        self._stop()
+
+        size = os.fstat(self.fd).st_size
+        try:
+            # release preallocated space that was not needed
+            os.ftruncate(self.fd, size)
+            if self.sync:
+                os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+        os.rename(self.tmp_fn, self.fn)
+
+        if self.sync:
+            dirfd = os.open(os.path.dirname(self.fn), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+        log.debug('Stored %d bytes in %s' % (size, self.fn))
+
+        return {'size': size}
+
+    def abort(self):
+        """Remove the file, once nothing is writing to it anymore."""
+        self._stop()
+        os.close(self.fd)
+        os.unlink(self.tmp_fn)
+        log.debug('Removed %s' % self.tmp_fn)
+
+    def _stop(self):
+        self._done.set()
+        self._watcher.join()
+
+    def _allocate(self, size):
+        # keep at least a minimum step of preallocated space ahead of the
+        # data written
+        if not self.preallocate or\
+           size + self.MIN_PREALLOCATION <= self.n_allocated:
+            return
+
+        step = min(self.MAX_PREALLOCATION,
+                   max(self.MIN_PREALLOCATION, self.n_allocated))
+        # the size of the file is left to the writer
+        self.preallocate = fallocate(self.fd, self.n_allocated + step,
+                                     keep_size=True)
+        if self.preallocate:
+            self.n_allocated += step
+            log.debug('Preallocated %d bytes for %s' % (self.n_allocated,
+                                                        self.tmp_fn))
+
+    def _watch(self):
+        while not self._done.wait(self.POLL_INTERVAL):
+            size = os.fstat(self.fd).st_size
+            self._allocate(size)
+
+            if self.sync and self.sync_interval and\
+               size - self.n_synced >= self.sync_interval:
+                os.fdatasync(self.fd)
+                self.n_synced = size
+
+
+class FilesystemBackend(Backend):
+    """Stores archives in a local directory.
+
+    The file descriptors handed out belong to the files themselves, so data
+    is written to disk by the pipeline without passing through another
+    process. See :py:class:`StoredFile`.
+    """
+
+    def __init__(self, basepath, sync_interval=64 * 1024 ** 2, sync=True):
+        super(FilesystemBackend, self).__init__()
         self.basepath = os.path.join(os.path.abspath(basepath))
+        self.sync_interval = sync_interval
+        self.sync = sync
+        self.stored_files = []
 
     def open_backup_archive(self, backup_id):
         """Returns a file descriptor to write to for storing the backup
         archive."""
-
-        fn = os.path.join(self.basepath, '%s%s' % (backup_id, ARCHIVE_ENDING))
-        log.debug('Opened filesystem archive: %s' % fn)
-        return os.open(fn, os.O_CREAT | os.O_WRONLY | os.O_EXCL)
+        return self._open_stored_file(backup_id + ARCHIVE_ENDING)
 
     def open_backup_meta(self, backup_id):
-        fn = os.path.join(self.basepath, '%s%s' % (backup_id, META_ENDING))
-        log.debug('Opened filesystem meta: %s' % fn)
-        return os.open(fn, os.O_CREAT | os.O_WRONLY | os.O_EXCL)
+        return self._open_stored_file(backup_id + META_ENDING)
+
+    def open_backup_meta_read(self, backup_id):
+        """Returns a file descriptor to read a stored meta archive from."""
+        return os.open(os.path.join(self.basepath, backup_id + META_ENDING),
+                       os.O_RDONLY)
+
+    def list_archives(self):
+        """Return all stored archives and meta archives.
+
+        :return: A dictionary of dictionaries holding the ``size`` (and, if
+                 known, the ``etag``) of every file, by name.
+        """
+        listing = {}
+        for name in os.listdir(self.basepath):
+            if not name.startswith('.') and (name.endswith(ARCHIVE_ENDING) or
+                                             name.endswith(META_ENDING)):
+                listing[name] = {
+                    'size': os.path.getsize(os.path.join(self.basepath, name))
+                }
+
+        return listing
+
+    def wait_for_completion(self):
+        """Complete all files opened since the last call. Everything writing
+        to them must have finished.
+
+        :return: A dictionary of the manifests of these files, by name.
+        """
+        manifests = {}
+        while self.stored_files:
+            name, stored_file = self.stored_files.pop(0)
+            manifests[name] = stored_file.finish()
+
+        return manifests
+
+    def abort(self):
+        """Remove all files opened since the last call, instead of
+        completing them."""
+        while self.stored_files:
+            name, stored_file = self.stored_files.pop(0)
+            stored_file.abort()
+
+    def _open_stored_file(self, name):
+        fn = os.path.join(self.basepath, name)
 
+        # the temporary file is only renamed once complete
+        if os.path.exists(fn):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), fn)
 
-class BotoBackend(object):
+        stored_file = StoredFile(fn, self.sync_interval, self.sync)
+        self.stored_files.append((name, stored_file))
+        log.debug('Opened filesystem file: %s' % stored_file.tmp_fn)
+
+        # the caller closes its file descriptor once done, the original is
+        # needed to complete the file
+        return os.dup(stored_file.fd)
+
+
+class BotoBackend(Backend):
     # see: http://docs.amazonwebservices.com/AmazonS3/latest/dev/qfacts.html
     MAX_FILESIZE = 5 * 1024 ** 4  # 5 TB when using multi-upload
     MULTI_UPLOAD_THRESHOLD = 5 * 1024 ** 2  # 5 MB minimum size
     MULTI_UPLOAD_MAX_PARTS = 10000  # parts are numbered 1-10000 (inclusive!)
-    MULTI_UPLOAD_MIN_FILE_SIZE = 5 ** 1024 * 2
+    MULTI_UPLOAD_MIN_FILE_SIZE = 5 * 1024 ** 2
+    MULTI_UPLOAD_MAX_FILE_SIZE = 5 * 1024 ** 3  # 5 GB maximum part size
+
+    # part sizes double every this many parts, starting at the minimum size.
+    # 10 steps of 1000 parts add up to a little under 5 TB
+    PART_SIZE_STEP = 1000
+
+    # seconds to wait before retrying a part, doubling with every failure
+    RETRY_DELAY = 1.0
+    RETRY_MAX_DELAY = 60.0
+
+    # seconds between checks whether the upload workers are still alive
+    RESULT_POLL_INTERVAL = 5.0
+
+    # upload processes start worker processes of their own, which daemonic
+    # processes are not allowed to
+    daemonic_tasks = False
 
     def __init__(self, access_key,
                        secret_key,
                        bucket_name,
                        prefix,
-                       pool_size=6):
+                       pool_size=6,
+                       min_pool_size=1,
+                       bandwidth=None,
+                       host=None,
+                       port=None,
+                       is_secure=True):
+        super(BotoBackend, self).__init__()
         self.access_key = access_key
         self.secret_key = secret_key
         self.bucket_name = bucket_name
-        self.prefix = prefix
+        self.prefix = prefix.strip('/')
         self.pool_size = pool_size
+        self.min_pool_size = min_pool_size
         self.num_retries = 10
 
-        self.running_tasks = []
-
-    def open_backup_archive(self, backup_id,
-                                  uncompressed_size,
-                                  ):
-        return self._create_upload_process(
-            key_name=self.prefix + '/' + backup_id + ARCHIVE_ENDING,
-            # 1% + 1 megabyte safety margins
-            expected_size=uncompressed_size * 1.01 + 1024**2,
-        )
-
-    def open_backup_meta(self, backup_id):
-        return self._create_upload_process(
-            key_name=self.prefix + '/' + backup_id + META_ENDING,
-        )
-
-    def wait_for_completion(self):
-        for task in self.running_tasks:
-            task.join()
-            self.running_tasks.remove(task)
-
-    def _calc_part_size(self, total_size):
-        if total_size > self.MAX_FILESIZE:
-            raise ValueError(
-                'Total expected size of %d exceeds maximum size of %d'\
-                % (total_size, self.MAX_FILESIZE)
-            )
-
-        if total_size < self.MULTI_UPLOAD_THRESHOLD:
-            return None  # none == use single file upload
-
-        part_size = total_size // self.MULTI_UPLOAD_MAX_PARTS
-        if total_size % self.MULTI_UPLOAD_MAX_PARTS:
-            # does not divide evenly
-            part_size += 1
-
-        if part_size < self.MULTI_UPLOAD_MIN_FILE_SIZE:
-            part_size = self.MULTI_UPLOAD_MIN_FILE_SIZE
-
-        log.debug('Calculated part size %d from total size %d' % (
-            part_size, total_size
-        ))
-
-        return part_size
-
-    def _create_upload_process(self, **kwargs):
-        fdreg = FileDescriptorRegistry.get_global_instance()
-        task_r, task_w = fdreg.pipe()
-        kwargs['fd'] = task_r
-        task = multiprocessing.Process(
-            target=fdreg.closing_all_except([task_r])(self._upload_fd),
-            kwargs=kwargs
-        )
-        task.daemon = True
-        task.start()
-
-        log.debug('Started upload background process, pid %d' % task.pid)
+        # shared by all upload processes of this backend, so must be created
+        # before any of them are started
+        self.token_bucket = TokenBucket(bandwidth) if bandwidth else None
 
-        self.running_tasks.append(task)
+        # other S3-compatible services
+        self.connection_args = {'is_secure': is_secure}
+        if host:
+            self.connection_args['host'] = host
+            from boto.s3.connection import OrdinaryCallingFormat
+            self.connection_args['calling_format'] = OrdinaryCallingFormat()
+        if port:
+            self.connection_args['port'] = port
 
-        return task_w
+    def open_backup_archive(self, backup_id):
+        return self._create_upload_process(backup_id + ARCHIVE_ENDING)
 
-    def _initialize_workers(self, queue_size, *args):
+    def open_backup_meta(self, backup_id):
+        return self._create_upload_process(backup_id + META_ENDING)
+
+    def open_backup_meta_read(self, backup_id):
+        """Returns a file descriptor to read a stored meta archive from."""
+        name = backup_id + META_ENDING
+        return self._create_task_process(self._download_fd,
+                                         name=name,
+                                         for_reading=True,
+                                         key_name=self._key_name(name))
+
+    def list_archives(self):
+        """Return all stored archives and meta archives.
+
+        :return: A dictionary of dictionaries holding the ``size`` and
+                 ``etag`` of every file, by name.
+        """
+        listing = {}
+        prefix = self._key_name('')
+        for key in self._open_boto_bucket().list(prefix=prefix):
+            name = key.name[len(prefix):]
+            if name.endswith(ARCHIVE_ENDING) or name.endswith(META_ENDING):
+                listing[name] = {
+                    'size': key.size,
+                    'etag': key.etag.strip('"'),
+                }
+
+        return listing
+
+    def _collect_result(self, controller, key_name):
+        while True:
+            try:
+                part_num, n_bytes, duration, failures, error =\
+                    self._result_queue.get(timeout=self.RESULT_POLL_INTERVAL)
+                break
+            except Empty:
+                # workers only exit once told to, after all results are in
+                dead = [w for w in self.workers if not w.is_alive()]
+                if dead:
+                    raise Exception('Upload worker %d died (exit code %s)' % (
+                        dead[0].pid, dead[0].exitcode
+                    ))
+
+        for i in xrange(failures):
+            controller.failed()
+
+        if error:
+            if part_num is None:
+                raise Exception('Upload worker for "%s" failed: %s' % (
+                    key_name, error
+                ))
+            raise Exception('Giving up on part %d of "%s" after %d '\
+                            'attempts: %s' % (part_num, key_name, failures,
+                                              error))
+
+        controller.transferred(n_bytes, duration)
+        log.debug('Part %d done, %d bytes in %.1f seconds (%d B/s), '\
+                  'upload window is %d' % (
+                      part_num, n_bytes, duration,
+                      n_bytes / max(duration, 1e-6), controller.limit
+                  ))
+
+    def _create_upload_process(self, name):
+        return self._create_task_process(self._upload_fd,
+                                         name=name,
+                                         key_name=self._key_name(name))
+
+    def _download_fd(self, key_name, fd):
+        setproctitle('mob s3 download')
+        key = self._open_boto_bucket().get_key(key_name)
+        if key is None:
+            raise Exception('Key "%s" does not exist' % key_name)
+
+        with os.fdopen(fd, 'wb') as out:
+            key.get_contents_to_file(out)
+
+    def _initialize_workers(self, *args):
         log.debug('Initializing new set of workers')
-        self._part_queue = multiprocessing.JoinableQueue(queue_size)
+        # the number of queued parts is limited by the upload window, not by
+        # the queue
+        self._part_queue = multiprocessing.Queue()
+        self._result_queue = multiprocessing.Queue()
         self.workers = []
 
         for i in xrange(self.pool_size):
-            w = multiprocessing.Process(target=self._worker, args=args)
+            w = multiprocessing.Process(
+                target=profiled('upload_worker')(self._worker), args=args
+            )
             w.daemon = True
             w.start()
             self.workers.append(w)
 
-    def _mp_from_id(id, key_name):
+    def _key_name(self, name):
+        return self.prefix + '/' + name if self.prefix else name
+
+    def _remove(self, name):
+        # a failed multipart upload is cancelled by the upload process, but
+        # a truncated input may have been uploaded completely
+        self._open_boto_bucket().delete_key(self._key_name(name))
+
+    def _mp_from_id(self, id, key_name):
+        from boto.s3.multipart import MultiPartUpload
         bucket = self._open_boto_bucket()
-        mp = boto.s3.multipart.MultiPartUpload(bucket)
+        mp = MultiPartUpload(bucket)
         mp.id = id
         mp.key_name = key_name
 
@@ -138,96 +496,405 @@ class BotoBackend(object):
 
     def _join_workers(self):
         n = len(self.workers)
-        for i in n:
+        for i in xrange(n):
             self._part_queue.put(None)
 
         log.debug('Joining %d workers' % n)
-        self._part_queue.join()
+        for w in self.workers:
+            w.join()
         self.workers = []
 
     def _open_boto_bucket(self):
-        conn = S3Connection(self.access_key, self.secret_key)
+        from boto.s3.connection import S3Connection
+        conn = S3Connection(self.access_key, self.secret_key,
+                            **self.connection_args)
         bucket = conn.get_bucket(self.bucket_name)
         log.debug('Opened S3 connection, bucket "%s"' % self.bucket_name)
 
         return bucket
 
-    def _upload_fd(self, key_name, fd, expected_size=None):
+    def _part_sizes(self):
+        """Generate the sizes of parts of an upload of unknown length.
+
+        Uploads start out with the smallest allowed parts, part sizes double
+        every ``PART_SIZE_STEP`` parts. This keeps memory usage low for small
+        uploads while still allowing uploads close to the maximum object size
+        without exceeding the maximum number of parts."""
+        for part_num in xrange(self.MULTI_UPLOAD_MAX_PARTS):
+            yield min(self.MULTI_UPLOAD_MAX_FILE_SIZE,
+                      self.MULTI_UPLOAD_MIN_FILE_SIZE *\
+                      2 ** (part_num // self.PART_SIZE_STEP))
+
+        # anything beyond this does not fit, reading a single byte is enough
+        # to find out whether there is more
+        while True:
+            yield 1
+
+    def _part_reader(self, data):
+        fp = StringIO(data)
+        if self.token_bucket:
+            fp = ThrottledReader(fp, self.token_bucket)
+        if shared_bucket():
+            fp = ThrottledReader(fp, shared_bucket())
+
+        return fp
+
+    def _upload_fd(self, key_name, fd):
+        """Upload everything read from ``fd``.
+
+        Checksums are calculated for every part while reading. S3 checks the
+        MD5 sums of all transfers, they are also compared to the returned
+        ETags.
+
+        :return: A manifest of the upload, holding its ``size``, ``etag``,
+                 the ``sha256`` of all data and the ``parts`` as a list of
+                 ``[size, md5, sha256]`` lists.
+        """
+        setproctitle('mob s3 upload reader')
         bucket = self._open_boto_bucket()
-        part_size = self._calc_part_size(expected_size) if expected_size\
-                                                        else None
+        part_sizes = self._part_sizes()
+        stream_hash = sha256()
+        parts = []
+
+        def checksum(buf):
+            stream_hash.update(buf)
+            digest = md5(buf).digest()
+            parts.append([len(buf), hexlify(digest), sha256(buf).hexdigest()])
+            return hexlify(digest), b64encode(digest)
 
         # open fd for reading, this is means it will probably be closed
         # once this function returns
         inp = os.fdopen(fd, 'rb')
 
-        # fill buffer
+        # fill buffer, if the input ends before the first part is full, a
+        # single upload suffices
         log.debug('Prefilling buffer...')
-        if not part_size:
-            buf = inp.read()
-        else:
-            buf = inp.read(part_size)
+        buf = inp.read(next(part_sizes))
 
-        if part_size and len(buf) >= self.MULTI_UPLOAD_MIN_FILE_SIZE:
-            log.debug('Uploading fd %d using multipart uploading '\
-                      '(part_size %d, expected_size %d)' % (
-                           fd, part_size, expected_size
-                      ))
+        if len(buf) >= self.MULTI_UPLOAD_MIN_FILE_SIZE:
+            log.debug('Uploading fd %d to "%s" using multipart uploading' % (
+                fd, key_name
+            ))
 
             part_num = 1
-            mp = bucket.initialize_multipart_upload(key_name)
-
-            self._initialize_workers(
-                # try not to use more than 200 MB of ram if possible
-                10 if part_size < 10 * 1024 ** 2 else 1,
-                mp.id,
-                mp.key_name
-            )
-
-            while buf:
-                # queue upload
-                self._part_queue.put((part_num, buf))
-                part_num += 1
-
-                buf = inp.read(self.part_size)
+            mp = bucket.initiate_multipart_upload(key_name)
+            controller = AIMDController(self.min_pool_size, self.pool_size)
+
+            self._initialize_workers(mp.id, mp.key_name)
+
+            try:
+                in_flight = 0
+                while buf:
+                    # only read the next part once there's room in the upload
+                    # window, this also limits memory usage
+                    while in_flight >= controller.limit:
+                        self._collect_result(controller, key_name)
+                        in_flight -= 1
+
+                    if part_num > self.MULTI_UPLOAD_MAX_PARTS:
+                        raise ValueError('Upload exceeds the maximum number '\
+                                         'of %d parts' %
+                                         self.MULTI_UPLOAD_MAX_PARTS)
+
+                    # queue upload
+                    self._part_queue.put((part_num, buf, checksum(buf)))
+                    in_flight += 1
+                    part_num += 1
+
+                    buf = inp.read(next(part_sizes))
+
+                while in_flight:
+                    self._collect_result(controller, key_name)
+                    in_flight -= 1
+            except:
+                for w in self.workers:
+                    w.terminate()
+                # parts nobody is going to read must not keep this process
+                # from exiting
+                self._part_queue.cancel_join_thread()
+                mp.cancel_upload()
+                raise
 
             self._join_workers()
-            mp.complete_upload()
+            etag = mp.complete_upload().etag
+
+            # the ETag of a multipart upload is the MD5 of the MD5s of its
+            # parts
+            expected = '%s-%d' % (
+                md5(''.join(unhexlify(p[1]) for p in parts)).hexdigest(),
+                len(parts)
+            )
         else:
             log.debug('Uploading fd %d to "%s" using normal upload' %
                 (fd, key_name)
             )
 
+            from boto.s3.key import Key
             k = Key(bucket)
             k.key = key_name
-            k.set_contents_from_string(buf)
+            part_md5 = checksum(buf)
+            with slot(UPLOAD):
+                k.set_contents_from_file(self._part_reader(buf),
+                                         md5=part_md5,
+                                         size=len(buf))
+            etag = k.etag
+            expected = part_md5[0]
+
+        etag = etag.strip('"')
+        if etag != expected:
+            raise Exception('ETag of "%s" is %s, expected %s' % (
+                key_name, etag, expected
+            ))
 
         log.debug('Done uploading')
 
+        return {
+            'size': sum(p[0] for p in parts),
+            'etag': etag,
+            'sha256': stream_hash.hexdigest(),
+            'parts': parts,
+        }
+
+    def _upload_part(self, mp, key_name, part_num, part_data, part_md5):
+        """Upload a single part, retrying with growing delays.
+
+        :return: A result tuple for :py:meth:`_collect_result`.
+        """
+        failures = 0
+        error = None
+        start = time.time()
+        while True:
+            log.debug('Transfering part %d (attempt %d)' % (
+                part_num, failures+1)
+            )
+
+            try:
+                with slot(UPLOAD):
+                    start = time.time()
+                    key = mp.upload_part_from_file(
+                        self._part_reader(part_data),
+                        part_num,
+                        md5=part_md5,
+                        size=len(part_data)
+                    )
+
+                if key.etag.strip('"') != part_md5[0]:
+                    raise Exception('ETag %s does not match MD5 %s' % (
+                        key.etag, part_md5[0]
+                    ))
+                break
+            except Exception, e:
+                failures += 1
+                log.warning('Transfer of part %d of "%s" '\
+                            'failed (%d retries left): %s'\
+                % (part_num, key_name, self.num_retries-failures+1,
+                   str(e)))
+
+                if failures > self.num_retries:
+                    error = str(e)
+                    break
+
+                time.sleep(min(self.RETRY_MAX_DELAY,
+                               self.RETRY_DELAY * 2 ** (failures-1)))
+
+        log.debug('Done transfering part %d' % part_num)
+
+        return part_num, len(part_data), time.time()-start, failures, error
+
     def _worker(self, multipart_id, key_name):
         setproctitle('mob s3 upload worker')
 
-        bucket = self._open_boto_bucket()
+        job = None
+        try:
+            # find multipart upload
+            mp = self._mp_from_id(multipart_id, key_name)
 
-        # find multipart upload
-        mp = self._mp_from_id(multipart_id, key_name)
+            while True:
+                job = self._part_queue.get()
+                if job is None:
+                    break
 
-        while True:
-            part_num, part_data = self._part_queue.get()
+                self._result_queue.put(self._upload_part(mp, key_name, *job))
+                job = None
+        except:
+            # report the failure, the reader would wait for the result of
+            # this part forever otherwise
+            self._result_queue.put((job[0] if job else None, 0, 0.0, 0,
+                                    str(sys.exc_info()[1])))
+            raise
 
-            n = self.num_retries
-            while i<self.num_retries:
-                log.debug('Transfering part %d (attempt %d)' % (
-                    part_num, self.num_retries-n+1)
-                )
 
+class MultiBackend(Backend):
+    """Stores everything on several backends at once.
+
+    Data written is copied to every backend by a tee process. Each backend
+    gets a bounded buffer, once a slow backend has fallen behind by this
+    much, the others wait for it. A backend that fails is dropped while the
+    others continue, failures are reported per backend by
+    :py:meth:`wait_for_completion`.
+
+    :param backends: A list of ``(name, backend)`` tuples.
+    :param buffer_size: Number of bytes buffered per backend.
+    """
+
+    CHUNK_SIZE = 1024 ** 2
+
+    def __init__(self, backends, buffer_size=64 * 1024 ** 2):
+        super(MultiBackend, self).__init__()
+        self.backends = backends
+        self.buffer_size = buffer_size
+
+    def open_backup_archive(self, backup_id):
+        return self._create_tee_process(
+            backup_id + ARCHIVE_ENDING,
+            [b.open_backup_archive(backup_id)
+             for name, b in self.backends]
+        )
+
+    def open_backup_meta(self, backup_id):
+        return self._create_tee_process(
+            backup_id + META_ENDING,
+            [b.open_backup_meta(backup_id) for name, b in self.backends]
+        )
+
+    def wait_for_completion(self):
+        """Wait for all backends to finish.
+
+        :return: A dictionary of the manifests of all files stored since the
+                 last call, by name. The manifests of the different backends
+                 are merged, they all describe the same data.
+        :raise: An exception listing all backends that failed, after all
+                backends have finished.
+        """
+        failures = []
+
+        while self.running_tasks:
+            task, conn, name, for_reading = self.running_tasks.pop(0)
+            try:
+                errors = conn.recv()
+            except EOFError:
+                errors = None
+            conn.close()
+            task.join()
+
+            if task.exitcode or errors is None:
+                failures.extend((backend_name,
+                                 'Copying %s failed (exit code %d)' %
+                                 (name, task.exitcode))
+                                for backend_name, b in self.backends)
+                continue
+
+            for backend_name, error in errors:
+                failures.append((backend_name, 'Copying %s failed: %s' % (
+                    name, error
+                )))
+
+        # what reached a failed backend is incomplete, it must not be stored
+        # under the name of a complete file
+        failed = set(backend_name for backend_name, e in failures)
+
+        manifests = {}
+        for backend_name, b in self.backends:
+            if backend_name in failed:
                 try:
-                    mp.upload_part_from_file(StringIO(part_data), part_num)
+                    b.abort()
+                except Exception, e:
+                    log.error('%s: Removing incomplete files failed: %s' % (
+                        backend_name, e
+                    ))
+                continue
+
+            try:
+                for name, manifest in b.wait_for_completion().iteritems():
+                    manifests.setdefault(name, {}).update(manifest)
+            except Exception, e:
+                failures.append((backend_name, str(e)))
+
+        for backend_name, error in failures:
+            log.error('%s: %s' % (backend_name, error))
+
+        if failures:
+            raise Exception('Storing failed on %s' % ', '.join(
+                sorted(set(backend_name for backend_name, e in failures))
+            ))
+
+        return manifests
+
+    def abort(self):
+        while self.running_tasks:
+            task, conn, name, for_reading = self.running_tasks.pop(0)
+            conn.close()
+            task.join()
+
+        for backend_name, b in self.backends:
+            b.abort()
+
+    def _create_tee_process(self, name, fds):
+        fdreg = FileDescriptorRegistry.get_global_instance()
+        for fd in fds:
+            fdreg.add_fd(fd)
+
+        fd = self._create_task_process(self._tee_fd,
+                                       name=name,
+                                       keep_fds=fds,
+                                       destfds=fds)
+
+        # only the tee process writes to the backends
+        for destfd in fds:
+            fdreg.close(destfd)
+
+        return fd
+
+    def _tee_fd(self, fd, destfds):
+        """Copy everything read from ``fd`` to all of ``destfds``.
+
+        :return: A list of ``(backend_name, error)`` tuples for all backends
+                 that could not be written to.
+        """
+        setproctitle('mob tee')
+
+        errors = []
+        queues = []
+        writers = []
+
+        def write(backend_name, destfd, queue):
+            failed = False
+            while True:
+                buf = queue.get()
+                if buf is None:
                     break
-                except AWSConnectionError, e:
-                    log.warning('Transfer of part %d of "%s" '\
-                                'failed (%d retries left): %s'\
-                    % (part_num, key_name, n, str(e)))
-                    n -= 1
 
-        log.debug('Done transfering part %d' % part_num)
+                # keep draining the queue after a failure, so the reader
+                # never blocks on it
+                if failed:
+                    continue
+
+                try:
+                    while buf:
+                        buf = buf[os.write(destfd, buf):]
+                except OSError, e:
+                    log.error('Writing to %s failed: %s' % (backend_name, e))
+                    errors.append((backend_name, str(e)))
+                    failed = True
+
+            os.close(destfd)
+
+        maxsize = max(1, self.buffer_size // self.CHUNK_SIZE)
+        for (backend_name, b), destfd in zip(self.backends, destfds):
+            queue = Queue(maxsize)
+            t = Thread(target=write, args=(backend_name, destfd, queue))
+            t.start()
+            queues.append(queue)
+            writers.append(t)
+
+        while True:
+            buf = os.read(fd, self.CHUNK_SIZE)
+            for queue in queues:
+                queue.put(buf or None)
+            if not buf:
+                break
+
+        for t in writers:
+            t.join()
+
+        return errors
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# coding=utf8
+
+from calendar import timegm
+import sqlite3
+
+import logbook
+
+import meta
+
+log = logbook.Logger(__name__)
+
+# kinds of entries
+ARCHIVED = 'A'  # contents stored in the backup
+UPDATED = 'U'   # only metadata changed, contents are in an earlier backup
+DELETED = 'D'
+LINK = 'L'      # hardlink, contents are those of the file it links to
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS backups (
+    backup_id TEXT PRIMARY KEY,
+    series_id TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    volumes INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS entries (
+    backup_id TEXT NOT NULL REFERENCES backups(backup_id),
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    volume INTEGER,
+    content_print BLOB,
+    size INTEGER,
+    mode INTEGER,
+    uid INTEGER,
+    gid INTEGER,
+    atime REAL,
+    mtime REAL,
+    ctime REAL
+);
+
+CREATE INDEX IF NOT EXISTS entries_by_path ON entries (path, backup_id);
+CREATE INDEX IF NOT EXISTS entries_by_content ON entries (content_print);
+"""
+
+ENTRY_COLUMNS = ('backup_id', 'path', 'kind', 'volume', 'content_print',
+                 'size', 'mode', 'uid', 'gid', 'atime', 'mtime', 'ctime')
+
+
+class Catalog(object):
+    """A local index of the contents of all backups.
+
+    The catalog holds a row for every file that was archived, linked, had its
+    metadata updated or was deleted in a backup, allowing to look up
+    versions of files without fetching any meta archives. Everything in it
+    is taken from the meta archives, so it can always be rebuilt from
+    these.
+
+    :param filename: Filename of the SQLite database to use.
+    """
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+
+    def __contains__(self, backup_id):
+        return None != self.conn.execute(
+            'SELECT 1 FROM backups WHERE backup_id = ?', (backup_id,)
+        ).fetchone()
+
+    def add_backup(self, reader):
+        """Add the contents of a backup to the catalog.
+
+        :param reader: A :py:class:`~ministryofbackup.meta.MetaReader` of the
+                       meta archive of the backup. Entries are read as they
+                       are inserted.
+        """
+        info = reader.info
+        backup_id = info['backup-id']
+
+        def meta_columns(meta_tuple):
+            if meta_tuple is None:
+                return (None,) * 7
+            return tuple(meta_tuple[i] for i in (3, 0, 1, 2, 4, 5, 6))
+
+        def entries():
+            for kind, entry in reader:
+                if meta.MEMBER == kind:
+                    path, volume, content_print, meta_tuple = entry
+                    yield (backup_id, path, ARCHIVED, volume,
+                           buffer(content_print)
+                           if content_print is not None else None) +\
+                          meta_columns(meta_tuple)
+                elif meta.UPDATED == kind:
+                    path, meta_tuple = entry
+                    yield (backup_id, path, UPDATED, None, None) +\
+                          meta_columns(meta_tuple)
+                elif meta.DELETED == kind:
+                    yield (backup_id, entry, DELETED, None, None) +\
+                          meta_columns(None)
+                elif meta.LINK == kind:
+                    path, volume, target, content_print, meta_tuple = entry
+                    yield (backup_id, path, LINK, volume,
+                           buffer(content_print)) + meta_columns(meta_tuple)
+
+        with self.conn:
+            self.conn.execute('DELETE FROM entries WHERE backup_id = ?',
+                              (backup_id,))
+            self.conn.execute(
+                'INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?)', (
+                    backup_id,
+                    backup_id.split('@', 1)[0],
+                    timegm(info['timestamp']),
+                    info.get('volumes', 1),
+                )
+            )
+            self.conn.executemany(
+                'INSERT INTO entries VALUES (%s)' %
+                ', '.join('?' * len(ENTRY_COLUMNS)),
+                entries()
+            )
+
+    def clear(self):
+        """Remove everything from the catalog."""
+        with self.conn:
+            self.conn.execute('DELETE FROM entries')
+            self.conn.execute('DELETE FROM backups')
+
+    def close(self):
+        self.conn.close()
+
+    def versions(self, path, recursive=False, series_id=None):
+        """Return all recorded versions of a file.
+
+        :param path: Relative name of the file.
+        :param recursive: If ``True``, ``path`` is a directory and versions of
+                          all files below it are returned.
+        :param series_id: Only return versions from backups of this series,
+                          by default those of all series.
+        :return: A list of dictionaries with the columns of the entries as
+                 well as the ``timestamp`` of the backup, sorted by path and
+                 age.
+        """
+        where = []
+        params = []
+        if not recursive:
+            where.append('e.path = ?')
+            params.append(path)
+        elif path.strip('/'):
+            # a range of paths, unlike a prefix comparison, can use the index
+            # on paths. '0' is the character following '/'
+            prefix = path.rstrip('/')
+            where.append('e.path >= ? AND e.path < ?')
+            params.extend([prefix + '/', prefix + '0'])
+        if series_id is not None:
+            where.append('b.series_id = ?')
+            params.append(series_id)
+
+        cur = self.conn.execute(
+            'SELECT %s, b.timestamp FROM entries e JOIN backups b '
+            'ON e.backup_id = b.backup_id%s '
+            'ORDER BY e.path, b.timestamp, e.backup_id' % (
+                ', '.join('e.' + c for c in ENTRY_COLUMNS),
+                ' WHERE ' + ' AND '.join(where) if where else ''
+            ), params
+        )
+        return [dict(zip(ENTRY_COLUMNS + ('timestamp',), row))
+                for row in cur]
+
+    def restore_plan(self, path, recursive=False, before=None,
+                     series_id=None):
+        """Find out what to fetch to restore files as they were at some
+        point in time.
+
+        :param path: Relative name of a file or, with ``recursive``, a
+                     directory.
+        :param recursive: Restore all files below ``path``.
+        :param before: Unix timestamp, restore the state of the last backup
+                       made at or before this time. Defaults to the latest
+                       state.
+        :param series_id: Only consider backups of this series, by default
+                          those of all series.
+        :return: A dictionary of ``{(backup_id, volume): [path, ...]}``
+                 listing the archives holding the contents to restore.
+                 Deleted files are left out.
+        """
+        latest = {}
+        contents = {}
+        for v in self.versions(path, recursive, series_id):
+            if before is not None and v['timestamp'] > before:
+                continue
+            latest[v['path']] = v
+            if v['kind'] in (ARCHIVED, LINK):
+                contents[v['path']] = v
+
+        plan = {}
+        for p, v in latest.iteritems():
+            if DELETED == v['kind'] or not p in contents:
+                continue
+            c = contents[p]
+            if c['volume'] is None:
+                c = self._archived_content(c['content_print'], before,
+                                           series_id)
+                if c is None:
+                    log.warning('No archived contents for link %s' % p)
+                    continue
+            plan.setdefault((c['backup_id'], c['volume']), []).append(p)
+
+        return plan
+
+    def _archived_content(self, content_print, before=None, series_id=None):
+        # hardlinks recorded without contents refer to the latest archived
+        # file with the same content print
+        row = self.conn.execute(
+            'SELECT e.backup_id, e.volume FROM entries e JOIN backups b '
+            'ON e.backup_id = b.backup_id WHERE e.content_print = ? '
+            'AND e.kind = ? AND e.volume IS NOT NULL AND b.timestamp <= ? '
+            'AND (? IS NULL OR b.series_id = ?) '
+            'ORDER BY b.timestamp DESC, e.backup_id DESC LIMIT 1',
+            (content_print, ARCHIVED, before if before is not None else
+             2**62, series_id, series_id)
+        ).fetchone()
+        if row is None:
+            return None
+        return {'backup_id': row[0], 'volume': row[1]}
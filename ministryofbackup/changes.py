@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Detecting changed files by their metadata.
+
+A file whose meta print is unchanged is assumed to have unchanged contents,
+only the others need to be read. Meta prints are fixed binary records of a
+selection of stat fields instead of hashes, so records made with one
+selection can be converted to a smaller one.
+
+``atime`` is never used: reading a file, mob's own hashing included, changes
+it. Device and inode numbers change when a backup is made from a fresh
+snapshot (or a new mount of one); in snapshot mode, they are ignored as well.
+"""
+
+import struct
+
+
+def _ns(t):
+    return int(round(t * 1e9))
+
+
+# stat fields usable for change detection: struct format, value from a stat
+# result
+FIELDS = {
+    'size': ('Q', lambda s: s.st_size),
+    'mtime': ('q', lambda s: _ns(s.st_mtime)),
+    'ctime': ('q', lambda s: _ns(s.st_ctime)),
+    'mode': ('I', lambda s: s.st_mode),
+    'uid': ('I', lambda s: s.st_uid),
+    'gid': ('I', lambda s: s.st_gid),
+    'nlink': ('I', lambda s: s.st_nlink),
+    'dev': ('Q', lambda s: s.st_dev),
+    'ino': ('Q', lambda s: s.st_ino),
+}
+
+DEFAULT_FIELDS = ('size', 'mtime', 'ctime', 'mode', 'uid', 'gid', 'dev', 'ino')
+
+# not stable across snapshots
+SNAPSHOT_IGNORED = ('dev', 'ino')
+
+
+def change_fields(v):
+    """Parse a comma separated list of field names."""
+    fields = tuple(f.strip() for f in v.split(',') if f.strip())
+    for f in fields:
+        if not f in FIELDS:
+            raise ValueError('Unknown field %r, choose from %s' % (
+                f, ', '.join(sorted(FIELDS))
+            ))
+    if not fields:
+        raise ValueError('Need at least one field')
+    return fields
+
+
+class ChangeDetector(object):
+    """Creates meta prints from stat results.
+
+    :param fields: Names of the fields (see ``FIELDS``) to compare.
+    :param snapshot: Ignore device and inode numbers.
+    """
+
+    def __init__(self, fields=DEFAULT_FIELDS, snapshot=False):
+        if snapshot:
+            fields = [f for f in fields if not f in SNAPSHOT_IGNORED]
+        self.fields = tuple(fields)
+        self.record = struct.Struct(
+            '>' + ''.join(FIELDS[f][0] for f in self.fields)
+        )
+        self._getters = [FIELDS[f][1] for f in self.fields]
+
+    def __eq__(self, other):
+        return isinstance(other, ChangeDetector) and\
+               self.fields == other.fields
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ChangeDetector(%r)' % (self.fields,)
+
+    def meta_print(self, s):
+        """Return the meta print for a stat result."""
+        return self.record.pack(*[get(s) for get in self._getters])
+
+    def converter(self, other):
+        """Return a function converting meta prints made by the detector
+        ``other`` to ones made by this one, or ``None`` if ``other`` lacks
+        some of the fields needed."""
+        if self == other:
+            return lambda record: record
+        if not set(self.fields) <= set(other.fields):
+            return None
+
+        positions = [other.fields.index(f) for f in self.fields]
+
+        def convert(record):
+            values = other.record.unpack(record)
+            return self.record.pack(*[values[i] for i in positions])
+        return convert
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Running backups of many directories from a single long-running process.
+
+The daemon reads a configuration file with one section per backup set::
+
+    [DEFAULT]
+    password-file = /etc/mob/password
+
+    [daemon]
+    jobs = 2        ; backups running at the same time
+    cpu = 4         ; buffers compressed or encrypted at the same time
+    uploads = 8     ; parts uploaded at the same time
+    bwlimit = 4M    ; upload bandwidth of all backups together
+
+    [home]
+    directory = /home
+    destination = s3://KEY:SECRET@bucket/home file:///mnt/backup/home
+    db = /var/lib/mob/home.db
+    interval = 1d
+    priority = 10
+    volumes = 2
+
+Every backup set needs a ``password-file`` holding the archive password, as
+nobody is there to type it in. The files are read when the daemon starts.
+Besides ``directory``, ``destination``, ``interval``, ``priority`` and
+``password-file``, every option of a backup set is passed on as the command
+line option of the same name of ``mob backup`` (``yes`` for options without a
+value). Sets without an ``interval`` only run when triggered through the
+control socket. When several sets are due, those with the highest priority
+start first.
+
+Every backup runs in a forked process. Fingerprint databases are loaded by
+the daemon and kept in memory between runs, as are all modules. Once done, a
+backup sends the updated records back through a pipe, which the daemon reads
+bit by bit between serving the control socket. All backups share the limits
+configured in the ``daemon`` section, see :py:mod:`ministryofbackup.limits`.
+
+The control socket takes a single line per connection and answers with
+text: ``status`` lists all backup sets, ``run NAME`` starts a backup set as
+soon as possible and ``stop`` shuts down the daemon once running backups are
+finished. Errors are answered with a line starting with ``error:``.
+"""
+
+from ConfigParser import RawConfigParser
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import time
+
+import logbook
+import msgpack
+from setproctitle import setproctitle
+
+log = logbook.Logger(__name__)
+
+DAEMON_SECTION = 'daemon'
+
+# options of backup sets that are not passed on to "mob backup"
+JOB_OPTIONS = ('directory', 'destination', 'interval', 'priority',
+               'password-file')
+
+# seconds between checks for due and finished backups
+TICK = 1.0
+
+# seconds to wait for a command on the control socket
+CONTROL_TIMEOUT = 5.0
+
+# bytes of database records read from a finished backup at a time
+UPDATE_CHUNK_SIZE = 1024 ** 2
+
+
+class Job(object):
+    """A backup set run by the daemon.
+
+    :param name: Name of the set, the section in the configuration file.
+    :param args: Parsed arguments of ``mob backup`` for this set.
+    :param interval: Seconds between runs, ``None`` to run only when
+                     triggered.
+    :param priority: Due sets with higher priorities start first.
+    :param password: The archive password.
+    """
+
+    def __init__(self, name, args, interval=None, priority=0, password=None):
+        self.name = name
+        self.args = args
+        self.interval = interval
+        self.priority = priority
+        self.password = password
+
+        self.db = None
+        self.process = None
+        # the updated database records of a running backup
+        self.updates = None
+        self.queued = None
+        self.next_run = time.time() if interval else None
+        self.last_start = None
+        self.last_result = None
+        self.n_runs = 0
+
+    @property
+    def state(self):
+        if self.process is not None:
+            return 'running'
+        if self.queued is not None:
+            return 'queued'
+        return 'idle'
+
+
+class DatabaseUpdates(object):
+    """Receives the records of a database updated by a backup.
+
+    :param fd: Read end of the pipe the records arrive on, as a stream of
+               msgpack encoded ``(rel_name, meta_print, content_print)``
+               tuples ended by ``None``.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.meta_prints = {}
+        self.content_prints = {}
+        self.complete = False
+        self._unpacker = msgpack.Unpacker()
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def closed(self):
+        return self.fd is None
+
+    def read(self):
+        """Read and decode a chunk of records, closing the pipe once all
+        records have arrived."""
+        buf = os.read(self.fd, UPDATE_CHUNK_SIZE)
+        self._unpacker.feed(buf)
+        for record in self._unpacker:
+            if record is None:
+                self.complete = True
+                break
+            rel_name, meta_print, content_print = record
+            self.meta_prints[rel_name] = meta_print
+            self.content_prints[rel_name] = content_print
+
+        # processes started by the backup may still hold the write end, so
+        # the end of the records is not necessarily the end of the pipe
+        if self.complete or not buf:
+            self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def send_database(fd, db):
+    """Send the records of a database to :py:class:`DatabaseUpdates`."""
+    packer = msgpack.Packer()
+    with os.fdopen(fd, 'wb') as out:
+        for rel_name, meta_print in db.meta_prints.iteritems():
+            out.write(packer.pack((rel_name, meta_print,
+                                   db.content_prints[rel_name])))
+        out.write(packer.pack(None))
+
+
+def read_config(fn, parse_args):
+    """Read a daemon configuration file.
+
+    :param fn: Filename of the configuration file.
+    :param parse_args: Function parsing a list of command line arguments of
+                       ``mob backup``.
+    :return: A tuple of a dictionary of the options of the ``daemon``
+             section and a list of :py:class:`Job` instances.
+    """
+    from ministryofbackup import duration
+
+    config = RawConfigParser()
+    if not config.read(fn):
+        raise IOError('Could not read %s' % fn)
+
+    settings = {'jobs': 1, 'cpu': None, 'uploads': None, 'bwlimit': None}
+    if config.has_section(DAEMON_SECTION):
+        for key in ('jobs', 'cpu', 'uploads'):
+            if config.has_option(DAEMON_SECTION, key):
+                settings[key] = config.getint(DAEMON_SECTION, key)
+        if config.has_option(DAEMON_SECTION, 'bwlimit'):
+            from ministryofbackup.throttle import BandwidthSchedule
+            settings['bwlimit'] = BandwidthSchedule.parse(
+                config.get(DAEMON_SECTION, 'bwlimit')
+            )
+
+    jobs = []
+    for name in config.sections():
+        if DAEMON_SECTION == name:
+            continue
+        options = dict(config.items(name))
+        for key in ('directory', 'destination', 'password-file'):
+            if not key in options:
+                raise ValueError('Backup set %s lacks %s' % (name, key))
+
+        # passed to the backups directly, never as a command line option
+        with open(options['password-file']) as f:
+            password = f.read().strip()
+
+        argv = []
+        for key, value in sorted(options.iteritems()):
+            if key in JOB_OPTIONS:
+                continue
+            if value.lower() in ('yes', 'true', 'on'):
+                argv.append('--' + key)
+            else:
+                argv.extend(['--' + key, value])
+        argv.append(options['directory'])
+        argv.extend(options['destination'].split())
+
+        jobs.append(Job(name,
+                        parse_args(argv),
+                        duration(options['interval'])
+                        if 'interval' in options else None,
+                        int(options.get('priority', 0)),
+                        password))
+
+    return settings, jobs
+
+
+class Daemon(object):
+    """Schedules backup sets and serves the control socket.
+
+    :param jobs: A list of :py:class:`Job` instances.
+    :param run: Function running a backup, called with the arguments, the
+                database and the password of a job in a forked process.
+    :param load: Function loading the database of a job from its arguments,
+                 or ``None`` for jobs reading it on every run.
+    :param socket_path: Path of the control socket.
+    :param max_jobs: Number of backups running at the same time.
+    """
+
+    def __init__(self, jobs, run, load, socket_path, max_jobs=1):
+        self.jobs = dict((job.name, job) for job in jobs)
+        self.run = run
+        self.load = load
+        self.socket_path = socket_path
+        self.max_jobs = max(1, max_jobs)
+
+        self.stopping = False
+        self._sock = None
+
+    def serve_forever(self):
+        """Run backups until stopped, either through the control socket or by
+        SIGTERM or SIGINT. Running backups are always finished."""
+        for job in self.jobs.itervalues():
+            job.db = self.load(job.args)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.socket_path)
+        self._sock.listen(5)
+        log.notice('Serving %d backup sets, control socket is %s' % (
+            len(self.jobs), self.socket_path
+        ))
+
+        def stop(signum, frame):
+            self.stop()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        try:
+            while not self.stopping or self._running():
+                self._reap()
+                if not self.stopping:
+                    self._schedule()
+
+                updates = [job.updates for job in self._running()
+                           if not job.updates.closed]
+                try:
+                    readable, _, _ = select.select([self._sock] + updates,
+                                                   [], [], TICK)
+                except select.error, e:
+                    if errno.EINTR != e.args[0]:
+                        raise
+                    continue
+
+                # a chunk at a time, so the daemon stays responsive while
+                # receiving large databases
+                for ready in readable:
+                    if ready is not self._sock:
+                        ready.read()
+
+                if self._sock in readable:
+                    conn, _ = self._sock.accept()
+                    conn.settimeout(CONTROL_TIMEOUT)
+                    try:
+                        self._serve_client(conn)
+                    except socket.error, e:
+                        log.warning('Control connection failed: %s' % e)
+                    finally:
+                        conn.close()
+        finally:
+            self._sock.close()
+            os.unlink(self.socket_path)
+
+        log.notice('Daemon stopped')
+
+    def stop(self):
+        """Stop once the running backups are finished."""
+        if not self.stopping:
+            log.notice('Stopping, waiting for %d running backups' %
+                       len(self._running()))
+        self.stopping = True
+
+    def trigger(self, name):
+        """Queue a backup set to run as soon as a slot is free.
+
+        :return: ``False`` if it is already queued or running.
+        """
+        job = self.jobs[name]
+        if job.state != 'idle':
+            return False
+        job.queued = time.time()
+        return True
+
+    def status(self):
+        """Return a table describing all backup sets as a list of lines."""
+        def fmt(t):
+            return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))\
+                   if t else '-'
+
+        lines = ['%-16s %-8s %8s %5s %-19s %-19s %s' % (
+            'set', 'state', 'priority', 'runs', 'last start', 'next run',
+            'last result'
+        )]
+        for job in sorted(self.jobs.itervalues(),
+                          key=lambda job: (-job.priority, job.name)):
+            lines.append('%-16s %-8s %8d %5d %-19s %-19s %s' % (
+                job.name, job.state, job.priority, job.n_runs,
+                fmt(job.last_start), fmt(job.next_run),
+                job.last_result or '-',
+            ))
+        return lines
+
+    def _running(self):
+        return [job for job in self.jobs.itervalues()
+                if job.process is not None]
+
+    def _schedule(self):
+        now = time.time()
+        for job in self.jobs.itervalues():
+            if job.next_run is not None and job.next_run <= now and\
+               'idle' == job.state:
+                job.queued = now
+
+        queued = sorted((job for job in self.jobs.itervalues()
+                         if 'queued' == job.state),
+                        key=lambda job: (-job.priority, job.queued))
+        for job in queued[:self.max_jobs - len(self._running())]:
+            self._start(job)
+
+    def _start(self, job):
+        log.notice('Starting backup of %s' % job.name)
+        job.queued = None
+        job.last_start = time.time()
+        if job.interval:
+            job.next_run = job.last_start + job.interval
+
+        updates_r, updates_w = os.pipe()
+        job.process = multiprocessing.Process(target=self._run_job,
+                                              args=(job, updates_r, updates_w))
+        job.process.start()
+        os.close(updates_w)
+        job.updates = DatabaseUpdates(updates_r)
+
+    def _run_job(self, job, updates_r, updates_w):
+        setproctitle('mob job %s' % job.name)
+        self._sock.close()
+        os.close(updates_r)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        self.run(job.args, job.db, job.password)
+
+        # the backup updated its copy of the database, the daemon keeps the
+        # new state for the next run
+        if job.db is not None:
+            send_database(updates_w, job.db)
+
+    def _reap(self):
+        for job in self._running():
+            if job.process.is_alive():
+                continue
+
+            job.process.join()
+            if not job.process.exitcode:
+                # all records were written before the backup exited, read
+                # what is left in the pipe
+                while not job.updates.closed:
+                    job.updates.read()
+            job.updates.close()
+            job.n_runs += 1
+            duration = time.time() - job.last_start
+            if job.process.exitcode:
+                job.last_result = 'failed (exit code %d)' % \
+                                  job.process.exitcode
+                log.error('Backup of %s failed after %d seconds' % (
+                    job.name, duration
+                ))
+            else:
+                job.last_result = 'ok (%d seconds)' % duration
+                log.notice('Backup of %s finished after %d seconds' % (
+                    job.name, duration
+                ))
+                # jobs without a database in memory read theirs every run
+                if job.db is not None and job.updates.complete:
+                    job.db.meta_prints = job.updates.meta_prints
+                    job.db.content_prints = job.updates.content_prints
+                elif job.db is not None:
+                    log.warning('Backup of %s did not send its database, '
+                                'loading it again' % job.name)
+                    job.db = self.load(job.args)
+            job.process = None
+            job.updates = None
+
+    def _serve_client(self, conn):
+        f = conn.makefile('r+b')
+        words = f.readline().split()
+        command, params = (words[0], words[1:]) if words else (None, [])
+
+        if 'status' == command:
+            lines = self.status()
+        elif 'run' == command and params:
+            lines = []
+            for name in params:
+                if not name in self.jobs:
+                    lines.append('error: no backup set %s' % name)
+                elif self.stopping:
+                    lines.append('error: daemon is stopping')
+                elif self.trigger(name):
+                    lines.append('%s queued' % name)
+                else:
+                    lines.append('%s is already %s' % (
+                        name, self.jobs[name].state
+                    ))
+        elif 'stop' == command:
+            self.stop()
+            lines = ['stopping after %d running backups' %
+                     len(self._running())]
+        else:
+            lines = ['error: unknown command, use status, run NAME... '
+                     'or stop']
+
+        f.write(''.join(line + '\n' for line in lines))
+        f.close()
+
+
+def control(socket_path, command):
+    """Send a command to a running daemon.
+
+    :param socket_path: Path of the control socket.
+    :param command: The command as a list of words.
+    :return: The lines of the answer.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        f = sock.makefile('r+b')
+        f.write(' '.join(command) + '\n')
+        f.flush()
+        sock.shutdown(socket.SHUT_WR)
+        return [line.rstrip('\n') for line in f]
+    finally:
+        sock.close()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Comparing a directory with a fingerprint database in bounded memory.
+
+:py:class:`~ministryofbackup.Database` keeps every file found and every
+record of the database in memory, which limits the size of the trees it can
+handle to the memory available. Here, both sides are read as streams
+instead: files found while walking the directory and records read from the
+database file are collected in sorted runs, spilled to temporary files once
+they exceed a memory budget, and merged in path order. A merge join of the
+two sides yields new, updated and deleted files.
+
+Backups made this way write the new database in the same way, merging the
+records of all files found with the outcomes of archiving them.
+"""
+
+import heapq
+import os
+import shutil
+import stat
+import tempfile
+
+import logbook
+import msgpack
+
+from changes import ChangeDetector
+
+log = logbook.Logger(__name__)
+
+NEW = 'N'
+UPDATED = 'U'
+DELETED = 'D'
+
+# per record overhead of tuples and strings in memory, roughly
+RECORD_OVERHEAD = 200
+
+# runs merged at once, more are merged into a single run first
+MAX_RUNS = 64
+
+
+class SortedRuns(object):
+    """Collects records and returns them sorted, using temporary files for
+    everything beyond a memory budget.
+
+    Records are tuples of strings and numbers, sorted by their first item,
+    which must be unique.
+
+    :param budget: Approximate number of bytes of records kept in memory.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.records = []
+        self.size = 0
+        self.runs = []
+
+    def add(self, record):
+        self.records.append(record)
+        self.size += RECORD_OVERHEAD + sum(len(v) for v in record
+                                           if isinstance(v, str))
+        if self.size >= self.budget:
+            self._spill()
+
+    def __iter__(self):
+        self.records.sort()
+        streams = [self._read_run(run) for run in self.runs]
+        streams.append(iter(self.records))
+        return heapq.merge(*streams)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.records = []
+
+    def _spill(self):
+        self.records.sort()
+        self._write_run(self.records)
+        self.records = []
+        self.size = 0
+
+        if len(self.runs) >= MAX_RUNS:
+            runs, self.runs = self.runs, []
+            self._write_run(heapq.merge(*[self._read_run(run)
+                                          for run in runs]))
+            for run in runs:
+                run.close()
+
+    def _write_run(self, records):
+        run = tempfile.TemporaryFile(prefix='mobrun')
+        packer = msgpack.Packer()
+        for record in records:
+            run.write(packer.pack(record))
+        run.flush()
+        self.runs.append(run)
+        log.debug('Wrote sorted run %d (%d bytes)' % (len(self.runs),
+                                                      run.tell()))
+
+    def _read_run(self, run):
+        run.seek(0)
+        for record in msgpack.Unpacker(run):
+            yield tuple(record)
+
+
+def merge_join(left, right):
+    """Join two streams of records sorted by their unique first items.
+
+    :return: A generator of ``(key, left_record, right_record)`` tuples, the
+             record missing on one side being ``None``.
+    """
+    left, right = iter(left), iter(right)
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], l, None
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], None, r
+            r = next(right, None)
+        else:
+            yield l[0], l, r
+            l, r = next(left, None), next(right, None)
+
+
+def scan_runs(base, detector, budget):
+    """Walk a directory, collecting ``(rel_name, meta_print, size, inode)``
+    records of all files. ``inode`` is ``None``, except for regular files
+    with several links, which have the device and inode number joined by a
+    colon.
+
+    :return: A :py:class:`SortedRuns` instance.
+    """
+    runs = SortedRuns(budget)
+    for root, ds, fs in os.walk(base):
+        for f in fs:
+            full_name = os.path.join(root, f)
+            s = os.lstat(full_name)
+            inode = '%d:%d' % (s.st_dev, s.st_ino)\
+                    if s.st_nlink > 1 and stat.S_ISREG(s.st_mode) else None
+            runs.add((full_name[len(base)+1:], detector.meta_print(s),
+                      s.st_size, inode))
+    return runs
+
+
+def database_runs(infile, budget):
+    """Read the records of a database file without loading it as a whole.
+
+    :return: A tuple of :py:class:`SortedRuns` of ``(rel_name, meta_print)``
+             and ``(rel_name, content_print)`` records and the change
+             detection fields stored (``None`` for older databases).
+    """
+    meta_runs = SortedRuns(budget / 2)
+    content_runs = SortedRuns(budget / 2)
+    fields = None
+
+    unpacker = msgpack.Unpacker(infile)
+    for i in xrange(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if key in ('meta_prints', 'content_prints'):
+            runs = meta_runs if 'meta_prints' == key else content_runs
+            for j in xrange(unpacker.read_map_header()):
+                runs.add((unpacker.unpack(), unpacker.unpack()))
+        elif 'change_fields' == key:
+            fields = unpacker.unpack()
+        else:
+            unpacker.skip()
+
+    return meta_runs, content_runs, fields
+
+
+def join(base, infile, detector, budget):
+    """Walk a directory and read a database file, joining both in path
+    order.
+
+    Meta prints stored using other fields are converted like
+    :py:meth:`~ministryofbackup.Database.load` does. If that is not possible,
+    they are kept as they are, but cannot be compared.
+
+    :param base: Absolute path of the directory.
+    :param infile: File object of the database, or ``None`` for none.
+    :param detector: The
+                     :py:class:`~ministryofbackup.changes.ChangeDetector`.
+    :param budget: Approximate number of bytes to keep in memory.
+    :return: A generator of ``(rel_name, found, known)`` tuples, ``None``
+             standing in for the side a file is missing on. ``found`` is the
+             record of :py:func:`scan_runs`, ``known`` one of ``(rel_name,
+             meta_print, content_print, comparable)``.
+    """
+    # the budget is shared by the directory and the two sides of the
+    # database
+    found = scan_runs(base, detector, budget / 2)
+    if infile is not None:
+        meta_runs, content_runs, fields = database_runs(infile, budget / 2)
+    else:
+        meta_runs, content_runs, fields = SortedRuns(0), SortedRuns(0), None
+
+    convert = detector.converter(ChangeDetector(fields)) if fields else None
+    if convert is None and infile is not None:
+        log.notice('Database was made using other change detection fields, '
+                   'all files with records count as updated')
+
+    try:
+        known = ((rel_name,
+                  convert(m[1]) if convert and m else (m[1] if m else None),
+                  c[1] if c else None,
+                  convert is not None and m is not None)
+                 for rel_name, m, c in merge_join(meta_runs, content_runs))
+
+        for rel_name, f, k in merge_join(found, known):
+            yield rel_name, f, k
+    finally:
+        for runs in (found, meta_runs, content_runs):
+            runs.close()
+
+
+def is_updated(found, known):
+    """Check whether a file found has other metadata than its record, see
+    :py:func:`join`."""
+    return not known[3] or known[1] != found[1]
+
+
+def streaming_diff(base, infile, detector, budget):
+    """Compare a directory with a database file in path order.
+
+    See :py:func:`join` for parameters. Known files count as updated if
+    their stored meta prints cannot be compared.
+
+    :return: A generator of ``(kind, rel_name, size, content_print)`` tuples,
+             ``kind`` being one of ``NEW``, ``UPDATED`` and ``DELETED``.
+             ``size`` is that of the file found, ``content_print`` the one
+             stored in the database.
+    """
+    for rel_name, f, k in join(base, infile, detector, budget):
+        if k is None:
+            yield NEW, rel_name, f[2], None
+        elif f is None:
+            yield DELETED, rel_name, None, k[2]
+        elif is_updated(f, k):
+            yield UPDATED, rel_name, f[2], k[2]
+
+
+def dump_database(outfile, records, series_id, fields):
+    """Write a database file from a stream of records, in the format of
+    :py:meth:`~ministryofbackup.Database.dump`.
+
+    :param records: ``(rel_name, meta_print, content_print)`` tuples, each
+                    path only once.
+    :param series_id: Series id of the database.
+    :param fields: Change detection fields of the meta prints.
+    """
+    # the maps are preceded by their sizes, which are known once all
+    # records are written
+    packer = msgpack.Packer()
+    meta_spool = tempfile.TemporaryFile(prefix='mobdb')
+    content_spool = tempfile.TemporaryFile(prefix='mobdb')
+    n = 0
+    try:
+        for rel_name, meta_print, content_print in records:
+            key = packer.pack(rel_name)
+            meta_spool.write(key + packer.pack(meta_print))
+            content_spool.write(key + packer.pack(content_print))
+            n += 1
+
+        outfile.write(packer.pack_map_header(4))
+        for key, spool in (('meta_prints', meta_spool),
+                           ('content_prints', content_spool)):
+            outfile.write(packer.pack(key) + packer.pack_map_header(n))
+            spool.seek(0)
+            shutil.copyfileobj(spool, outfile)
+        outfile.write(packer.pack('series_id') + packer.pack(series_id))
+        outfile.write(packer.pack('change_fields') +
+                      packer.pack(list(fields)))
+    finally:
+        meta_spool.close()
+        content_spool.close()
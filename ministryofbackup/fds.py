@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 # coding=utf8
 
+import ctypes
+import ctypes.util
+import errno
 from functools import wraps
 import multiprocessing
 import os
@@ -8,8 +11,102 @@ import sys
 
 import logbook
 
+from profiling import profiled, stage_name
+
 log = logbook.Logger(__name__)
 
+# fallocate() is linux-specific and not available through the os module
+FALLOC_FL_KEEP_SIZE = 1
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                ctypes.c_int64, ctypes.c_int64]
+    _libc.fallocate.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _libc = None
+
+
+# lseek() whence values of linux for finding holes, not available through the
+# os module of python 2
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+
+def _unsupported(e):
+    return e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+def fallocate(fd, length, keep_size=False):
+    """Preallocate ``length`` bytes of disk space for a file.
+
+    :param keep_size: Leave the size of the file unchanged, preallocating
+                      space beyond its end.
+    :return: ``True`` if successful, ``False`` if not supported by the
+             filesystem or there is not enough space.
+    """
+    if not _libc or not length:
+        return False
+
+    if _libc.fallocate(fd, FALLOC_FL_KEEP_SIZE if keep_size else 0, 0,
+                       length):
+        e = OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        # the final file may still fit, even if the estimate does not
+        if _unsupported(e) or errno.ENOSPC == e.errno:
+            return False
+        raise e
+
+    return True
+
+
+def data_extents(fd, length, block_size=512):
+    """Find the parts of a file holding data, leaving out holes.
+
+    Extents are widened to whole blocks, taking in the zeros of the holes
+    around them. GNU tar stores every extent of a sparse member in blocks of
+    its own, tarfile expects them back to back; only extents of whole blocks
+    (but for one ending the file) read the same with both.
+
+    :param length: Size of the file, parts beyond it are ignored.
+    :param block_size: Size of the blocks extents are aligned to.
+    :return: A list of ``(offset, length)`` tuples, or ``None`` if holes
+             cannot be found on this system or filesystem. The file position
+             is reset to the start.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+
+    extents = []
+    offset = 0
+    try:
+        while offset < length:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError, e:
+                # nothing but a hole left
+                if errno.ENXIO == e.errno:
+                    break
+                raise
+            if start >= length:
+                break
+            end = os.lseek(fd, start, SEEK_HOLE)
+
+            start -= start % block_size
+            end = min(end + -end % block_size, length)
+            if extents and start <= sum(extents[-1]):
+                start = extents.pop()[0]
+            extents.append((start, end - start))
+            offset = end
+    except OSError, e:
+        if _unsupported(e):
+            return None
+        raise
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+
+    return extents
+
+
 class FileDescriptorRegistry(object):
     _global_instance = None
 
@@ -31,6 +128,11 @@ class FileDescriptorRegistry(object):
         self.fds.add(fd)
         log.debug('Added %d to FileDescriptorRegistry %s' % (fd, hash(self)))
 
+    def remove_fd(self, fd):
+        """Stop tracking a file descriptor that has been closed elsewhere,
+        e.g. by a file object wrapping it."""
+        self.fds.discard(fd)
+
     def chain_funcs(self, srcfd, destfd, funcs):
         ps = []
 
@@ -48,7 +150,9 @@ class FileDescriptorRegistry(object):
             fsrcfd = pipe_ends.pop(0)
             fdestfd = pipe_ends.pop(0)
 
-            target=self.closing_all_except((fsrcfd, fdestfd))(f)
+            target=self.closing_all_except((fsrcfd, fdestfd))(
+                profiled(stage_name(f))(f)
+            )
 
             p = multiprocessing.Process(target=target, args=(fsrcfd, fdestfd))
             p.daemon = True
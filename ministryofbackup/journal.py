@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""A journal of content prints calculated during a run.
+
+Reading files to find out whether they were altered is the slowest part of
+a run, but its results only reach the fingerprint database at the very end.
+The journal keeps them on disk in the meantime, so a run that crashes or is
+interrupted does not lose them. Every entry holds the meta print of the file
+at the time it was read, it is only used as long as the file's meta print is
+unchanged.
+
+The journal is a sequence of length-prefixed msgpack records::
+
+    'mobjrnl1'
+    [change_fields]                           fields the meta prints use
+    [rel_name, meta_print, content_print]     one per file
+    ...
+
+Records are written in checkpoints. A record cut short by a crash is
+dropped.
+"""
+
+import os
+import struct
+import threading
+import time
+
+import logbook
+import msgpack
+
+log = logbook.Logger(__name__)
+
+MAGIC = 'mobjrnl1'
+
+# seconds between checkpoints
+CHECKPOINT_INTERVAL = 30
+
+_length = struct.Struct('>I')
+
+
+class Journal(object):
+    """A journal file, read when opened and appended to afterwards.
+
+    :param filename: Filename of the journal, created if missing.
+    :param fields: The fields of the
+                   :py:class:`~ministryofbackup.changes.ChangeDetector` in
+                   use. A journal made with other fields is discarded.
+    :param interval: Seconds between checkpoints.
+    """
+
+    def __init__(self, filename, fields, interval=CHECKPOINT_INTERVAL):
+        self.filename = filename
+        self.fields = list(fields)
+        self.interval = interval
+        self.entries = {}
+        self.pending = []
+        self.last_checkpoint = time.time()
+        self.lock = threading.Lock()
+
+        end = self._read() if os.path.exists(filename) else None
+        if end is None:
+            self.entries = {}
+            self._create()
+        else:
+            if self.entries:
+                log.notice('Reusing %d content prints from journal %s' % (
+                    len(self.entries), filename
+                ))
+            self.f = open(filename, 'r+b')
+            # drop what a crash may have left of an incomplete record
+            self.f.truncate(end)
+            self.f.seek(end)
+
+    def lookup(self, rel_name, meta_print):
+        """Return the content print recorded for a file, or ``None`` if
+        there is none or the file's meta print changed since."""
+        entry = self.entries.get(rel_name)
+        if entry is not None and entry[0] == meta_print:
+            return entry[1]
+
+    def add(self, rel_name, meta_print, content_print):
+        """Record a content print, written out at the next checkpoint."""
+        with self.lock:
+            if self.entries.get(rel_name) == (meta_print, content_print):
+                return
+            self.entries[rel_name] = (meta_print, content_print)
+            self.pending.append([rel_name, meta_print, content_print])
+
+            if time.time() - self.last_checkpoint >= self.interval:
+                self._checkpoint()
+
+    def checkpoint(self):
+        """Write out all pending records and wait for them to reach the
+        disk."""
+        with self.lock:
+            self._checkpoint()
+
+    def clear(self, keep=()):
+        """Start over once the database holds the content prints.
+
+        :param keep: Relative names of files whose entries are kept, e.g.
+                     those deferred to the next run.
+        """
+        with self.lock:
+            kept = [[rel_name] + list(self.entries[rel_name])
+                    for rel_name in keep if rel_name in self.entries]
+            self.f.close()
+            self.entries = {}
+            self._create()
+            for record in kept:
+                self.entries[record[0]] = tuple(record[1:])
+            self.pending = kept
+            self._checkpoint()
+
+    def close(self):
+        self.checkpoint()
+        self.f.close()
+
+    def _create(self):
+        self.f = open(self.filename, 'wb')
+        self.f.write(MAGIC)
+        self._write_record(self.fields)
+        self.pending = []
+        self._checkpoint()
+
+    def _checkpoint(self):
+        for record in self.pending:
+            self._write_record(record)
+        self.pending = []
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.last_checkpoint = time.time()
+
+    def _write_record(self, record):
+        buf = msgpack.packb(record)
+        self.f.write(_length.pack(len(buf)) + buf)
+
+    def _read(self):
+        # returns the offset after the last complete record, None if the
+        # journal cannot be used
+        with open(self.filename, 'rb') as f:
+            if MAGIC != f.read(len(MAGIC)):
+                return None
+
+            fields = None
+            end = f.tell()
+            while True:
+                head = f.read(_length.size)
+                if len(head) < _length.size:
+                    break
+                n, = _length.unpack(head)
+                buf = f.read(n)
+                if len(buf) < n:
+                    break
+
+                record = msgpack.unpackb(buf)
+                if fields is None:
+                    fields = record
+                    if fields != self.fields:
+                        log.notice('Journal %s was made using other change '
+                                   'detection fields, ignoring it' %
+                                   self.filename)
+                        return None
+                else:
+                    rel_name, meta_print, content_print = record
+                    self.entries[rel_name] = (meta_print, content_print)
+                end = f.tell()
+
+        return end if fields is not None else None
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Limits shared by all backups running on a host at the same time.
+
+Once :py:func:`configure` has been called, processes started afterwards share
+a bounded number of slots per kind of work and, optionally, an upload
+bandwidth limit. Stages take a slot only while working on a single buffer or
+part, never while waiting for their input, so pipelines cannot block each
+other by holding slots. Without limits configured, slots are free.
+"""
+
+from contextlib import contextmanager
+import multiprocessing
+
+from throttle import TokenBucket
+
+# compressing and encrypting buffers
+CPU = 'cpu'
+# transferring upload parts
+UPLOAD = 'upload'
+
+_slots = {}
+_bucket = None
+
+
+def configure(slots=None, bandwidth=None):
+    """Set up shared limits, must be called before forking the processes
+    that use them.
+
+    :param slots: A dictionary of ``{kind: n}``, ``n`` being the number of
+                  stages that may do this kind of work at the same time.
+    :param bandwidth: A :py:class:`~ministryofbackup.throttle.BandwidthSchedule`
+                      limiting all uploads together.
+    """
+    global _bucket
+
+    _slots.clear()
+    for kind, n in (slots or {}).iteritems():
+        if n:
+            _slots[kind] = multiprocessing.BoundedSemaphore(n)
+    _bucket = TokenBucket(bandwidth) if bandwidth else None
+
+
+@contextmanager
+def slot(kind):
+    """Hold a slot of ``kind`` while running the body of a with-statement."""
+    sem = _slots.get(kind)
+    if sem is None:
+        yield
+        return
+
+    sem.acquire()
+    try:
+        yield
+    finally:
+        sem.release()
+
+
+def shared_bucket():
+    """Return the :py:class:`~ministryofbackup.throttle.TokenBucket` shared by
+    all uploads, or ``None``."""
+    return _bucket
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Meta archives describe the contents of a backup.
+
+A ``metamob2`` meta archive is a stream of msgpack records, so it can be
+written while files are processed and read without loading it completely::
+
+    'metamob2'
+    ['B', {backup-id, timestamp, volumes}]   backup info, always first
+    [KIND, [entry, entry, ...]]              blocks of up to BLOCK_SIZE entries
+    ...
+    ['S', {...}]                             summary (manifest, ...)
+
+Entries are, by kind:
+
+* ``M`` (member, archived in this backup):
+  ``[rel_name, volume, content_print, meta_tuple]``
+* ``U`` (updated metadata, contents are in an earlier backup):
+  ``[rel_name, meta_tuple]``
+* ``D`` (deleted): ``rel_name``
+* ``L`` (further hardlink to the inode of ``target``):
+  ``[rel_name, volume, target, content_print, meta_tuple]``. With a
+  ``volume``, the archive of that volume holds a tar hardlink entry for it.
+  Without one (``None``), its contents are those of an earlier backup of a
+  file with the same ``content_print``.
+
+``metamob1`` meta archives, a single msgpack dictionary, can still be read.
+"""
+
+import msgpack
+
+MAGIC_V1 = 'metamob1'
+MAGIC = 'metamob2'
+
+INFO = 'B'
+MEMBER = 'M'
+UPDATED = 'U'
+DELETED = 'D'
+LINK = 'L'
+SUMMARY = 'S'
+
+BLOCK_SIZE = 1000
+
+
+class MetaWriter(object):
+    """Writes a meta archive record by record.
+
+    :param fileobj: File object to write to.
+    :param info: Dictionary with ``backup-id``, ``timestamp`` and ``volumes``.
+    :param block_size: Maximum number of entries per record.
+    """
+
+    def __init__(self, fileobj, info, block_size=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.pending = {}
+        self.offset = 0
+
+        self._write(MAGIC)
+        self._write_record(INFO, info)
+
+    def add(self, kind, entry):
+        """Add an entry, see the module documentation for their format."""
+        block = self.pending.setdefault(kind, [])
+        block.append(entry)
+
+        if len(block) >= self.block_size:
+            self._flush(kind)
+
+    def finish(self, summary):
+        """Write out all pending entries and the summary.
+
+        :param summary: Dictionary of everything not known at the start.
+        """
+        for kind in sorted(self.pending):
+            self._flush(kind)
+
+        self._write_record(SUMMARY, summary)
+
+    def _flush(self, kind):
+        block = self.pending.pop(kind, None)
+        if block:
+            self._write_record(kind, block)
+
+    def _write(self, buf):
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+
+    def _write_record(self, kind, data):
+        self._write(msgpack.packb([kind, data]))
+
+
+class MetaReader(object):
+    """Reads a meta archive lazily.
+
+    The backup info is read right away and available as ``info``. Iterating
+    over the reader yields ``(kind, entry)`` tuples. Once everything has been
+    read, ``summary`` holds the summary.
+
+    :param fileobj: File object to read from.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.summary = None
+
+        magic = fileobj.read(len(MAGIC))
+        if MAGIC_V1 == magic:
+            self._records = self._convert_v1(msgpack.load(fileobj))
+        elif MAGIC == magic:
+            self._records = iter(msgpack.Unpacker(fileobj))
+        else:
+            raise Exception('Not a meta archive of a version I know')
+
+        kind, self.info = next(self._records)
+        assert INFO == kind
+
+    def __iter__(self):
+        for kind, data in self._records:
+            if SUMMARY == kind:
+                self.summary = data
+                continue
+            for entry in data:
+                yield kind, entry
+
+    def _convert_v1(self, meta):
+        meta = dict(meta)
+        yield INFO, {
+            'backup-id': meta.pop('backup-id'),
+            'timestamp': meta.pop('timestamp'),
+            'volumes': meta.pop('volumes', 1),
+        }
+
+        members = meta.pop('members', {})
+        updated = meta.pop('updated', {})
+        deleted = meta.pop('deleted', [])
+
+        entries = []
+        for rel_name, member in members.iteritems():
+            # early meta archives only record the volume
+            if isinstance(member, (int, long)):
+                entries.append([rel_name, member, None, None])
+            else:
+                entries.append([rel_name] + list(member))
+        yield MEMBER, entries
+
+        yield UPDATED, [[rel_name, meta_tuple]
+                        for rel_name, meta_tuple in updated.iteritems()
+                        if not rel_name in members]
+        yield DELETED, deleted
+        yield SUMMARY, meta
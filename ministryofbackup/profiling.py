@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# coding=utf8
+
+"""Profiling of all processes taking part in a backup.
+
+Once :py:func:`enable` has been called, every function wrapped using
+:py:func:`profiled` writes a profile of each of its runs to the profile
+directory. Processes started afterwards inherit this setting. The profiles
+are merged by :py:func:`report`, one report per stage.
+"""
+
+from functools import wraps, WRAPPER_ASSIGNMENTS
+import glob
+import os
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+_profile_dir = None
+
+
+def enable(directory):
+    """Turn on profiling for this process and all processes started from now
+    on.
+
+    :param directory: Directory to write profiles to, created if missing.
+                      Profiles left by earlier runs are removed, so reports
+                      only cover this one.
+    """
+    global _profile_dir
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    stale = glob.glob(os.path.join(directory, '*.prof'))
+    for fn in stale:
+        os.unlink(fn)
+    if stale:
+        log.debug('Removed %d profiles of earlier runs' % len(stale))
+    _profile_dir = os.path.abspath(directory)
+
+
+def profiled(stage):
+    """Decorator that profiles a function if profiling is enabled.
+
+    :param stage: Label of the stage the function runs, profiles of the same
+                  stage are merged in reports.
+    """
+    def decorator(f):
+        # partials lack __name__ and friends
+        @wraps(f, assigned=[a for a in WRAPPER_ASSIGNMENTS if hasattr(f, a)])
+        def _(*args, **kwargs):
+            if not _profile_dir:
+                return f(*args, **kwargs)
+
+            import cProfile
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(f, *args, **kwargs)
+            finally:
+                fn = os.path.join(_profile_dir, '%s.%d.%d.prof' % (
+                    stage, os.getpid(), id(profile)
+                ))
+                profile.dump_stats(fn)
+                log.debug('Wrote profile of %s to %s' % (stage, fn))
+        return _
+    return decorator
+
+
+def stage_name(f):
+    """Name a stage after the function run in it (looking through
+    :py:func:`functools.partial`)."""
+    f = getattr(f, 'func', f)
+    return getattr(f, '__name__', 'unknown').strip('_')
+
+
+def report(directory, stream, limit=25):
+    """Merge the profiles in a directory by stage and write a report.
+
+    :param directory: Directory the profiles were written to.
+    :param stream: File object to write the report to.
+    :param limit: Number of functions to list per stage.
+    :return: A list of ``(stage, n_profiles, total_time)`` tuples.
+    """
+    import pstats
+
+    stages = {}
+    for fn in sorted(glob.glob(os.path.join(directory, '*.prof'))):
+        stage = os.path.basename(fn).split('.', 1)[0]
+        stages.setdefault(stage, []).append(fn)
+
+    summary = []
+    for stage, fns in sorted(stages.iteritems()):
+        stats = pstats.Stats(*fns, stream=stream)
+        summary.append((stage, len(fns), stats.total_tt))
+
+        stream.write('=' * 79 + '\n')
+        stream.write('%s: %d processes, %.3f seconds\n' % (stage, len(fns),
+                                                          stats.total_tt))
+        stream.write('=' * 79 + '\n')
+        stats.sort_stats('cumulative').print_stats(limit)
+
+    return summary
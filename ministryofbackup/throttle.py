@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# coding=utf8
+
+import multiprocessing
+import time
+
+import logbook
+
+log = logbook.Logger(__name__)
+
+
+class BandwidthSchedule(object):
+    """A bandwidth limit that depends on the time of day.
+
+    :param rules: A list of ``(start, end, rate)`` tuples. ``start`` and
+                  ``end`` are minutes since midnight (a rule may wrap around
+                  midnight), ``rate`` is in bytes per second or ``None`` for
+                  unlimited.
+    :param default: Rate to use when no rule matches.
+    """
+
+    def __init__(self, rules=None, default=None):
+        self.rules = rules or []
+        self.default = default
+
+    def rate_at(self, minute):
+        """Return the rate active at ``minute`` minutes after midnight."""
+        for start, end, rate in self.rules:
+            if start <= end:
+                if start <= minute < end:
+                    return rate
+            elif minute >= start or minute < end:
+                return rate
+
+        return self.default
+
+    def current_rate(self):
+        t = time.localtime()
+        return self.rate_at(t.tm_hour * 60 + t.tm_min)
+
+    @classmethod
+    def parse(cls, v):
+        """Parse a schedule from a string.
+
+        The string is a comma separated list of rules of the form
+        ``HH:MM-HH:MM=RATE``. A single rule without a time range sets the
+        default rate. Rates are sizes per second (e.g. ``512k``), ``off``
+        disables the limit. Example: ``08:00-18:00=1M,off``.
+        """
+        from ministryofbackup import byte_size
+
+        def parse_rate(r):
+            if r.strip().lower() in ('off', 'unlimited'):
+                return None
+            return byte_size(r)
+
+        def parse_time(t):
+            hours, minutes = t.strip().split(':')
+            minute = int(hours) * 60 + int(minutes)
+            if not 0 <= minute <= 24 * 60:
+                raise ValueError('Not a valid time of day: %s' % t)
+            return minute
+
+        rules = []
+        default = None
+        for rule in v.split(','):
+            if '=' in rule:
+                span, rate = rule.split('=', 1)
+                start, end = span.split('-', 1)
+                rules.append((parse_time(start), parse_time(end),
+                              parse_rate(rate)))
+            else:
+                default = parse_rate(rule)
+
+        return cls(rules, default)
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.rules,
+                               self.default)
+
+
+class TokenBucket(object):
+    """A token bucket shared between processes.
+
+    Each byte sent costs one token, tokens are refilled at the rate currently
+    given by the schedule. Consumers that overdraw the bucket sleep until it
+    is balanced again. The bucket holds at most one second worth of tokens.
+
+    Must be created before forking the processes that use it.
+
+    :param schedule: A :py:class:`BandwidthSchedule`.
+    """
+
+    def __init__(self, schedule):
+        self.schedule = schedule
+        self._lock = multiprocessing.Lock()
+        self._tokens = multiprocessing.Value('d', 0, lock=False)
+        self._last = multiprocessing.Value('d', time.time(), lock=False)
+
+    def consume(self, n):
+        """Take ``n`` tokens, blocking as long as necessary."""
+        rate = self.schedule.current_rate()
+
+        with self._lock:
+            now = time.time()
+            if not rate:
+                self._tokens.value = 0
+                self._last.value = now
+                return
+
+            tokens = self._tokens.value + (now - self._last.value) * rate
+            tokens = min(tokens, rate) - n
+            self._tokens.value = tokens
+            self._last.value = now
+
+        if tokens < 0:
+            time.sleep(-tokens / rate)
+
+
+class ThrottledReader(object):
+    """Wraps a file object, consuming tokens from a bucket for every byte
+    read.
+
+    :param fileobj: The file object to wrap, must support ``seek`` and
+                    ``tell``.
+    :param bucket: A :py:class:`TokenBucket`.
+    """
+
+    def __init__(self, fileobj, bucket):
+        self.fileobj = fileobj
+        self.bucket = bucket
+
+    def read(self, size=-1):
+        buf = self.fileobj.read(size)
+        if buf:
+            self.bucket.consume(len(buf))
+        return buf
+
+    def seek(self, *args):
+        return self.fileobj.seek(*args)
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def close(self):
+        return self.fileobj.close()
+
+
+class AIMDController(object):
+    """Decides how many parts may be uploaded at the same time.
+
+    The window grows additively by one part per window of successful
+    transfers. A transfer whose throughput drops below a fraction of the
+    best throughput seen so far signals a congested link (or a bandwidth
+    cap kicking in), as does a failed transfer; either halves the window.
+    The best throughput is decayed slowly, so the controller adapts to a
+    changing link.
+
+    :param min_window: Lower bound of parallel transfers.
+    :param max_window: Upper bound of parallel transfers.
+    :param congestion_threshold: Fraction of the best throughput below which
+                                 a transfer counts as congested.
+    :param backoff: Factor applied to the window on congestion.
+    :param decay: Factor applied to the best throughput on every transfer.
+    """
+
+    def __init__(self, min_window=1,
+                       max_window=6,
+                       congestion_threshold=0.5,
+                       backoff=0.5,
+                       decay=0.98):
+        # a window below one part would never let a transfer start
+        self.min_window = max(1, min_window)
+        self.max_window = max(self.min_window, max_window)
+        self.congestion_threshold = congestion_threshold
+        self.backoff = backoff
+        self.decay = decay
+
+        self.window = float(self.min_window)
+        self.best_rate = None
+        self._cooldown = 0
+
+    @property
+    def limit(self):
+        """Number of transfers allowed to be in flight right now."""
+        return int(self.window)
+
+    def _decrease(self, reason):
+        # react at most once per window, transfers that were in flight
+        # when the congestion started will report it as well
+        if self._cooldown:
+            return
+        self.window = max(self.min_window, self.window * self.backoff)
+        self._cooldown = self.limit
+        log.debug('%s, window decreased to %.2f' % (reason, self.window))
+
+    def transferred(self, n_bytes, duration):
+        """Report a successful transfer of ``n_bytes`` in ``duration``
+        seconds."""
+        rate = n_bytes / max(duration, 1e-6)
+        if self._cooldown:
+            self._cooldown -= 1
+
+        if self.best_rate is None or rate > self.best_rate:
+            self.best_rate = rate
+        else:
+            self.best_rate *= self.decay
+
+        if rate < self.best_rate * self.congestion_threshold:
+            self._decrease('Congestion detected (%d B/s, best %d B/s)' % (
+                rate, self.best_rate
+            ))
+        else:
+            self.window = min(self.max_window,
+                              self.window + 1.0 / self.window)
+
+    def failed(self):
+        """Report a failed transfer attempt."""
+        if self._cooldown:
+            self._cooldown -= 1
+        self._decrease('Transfer failed')
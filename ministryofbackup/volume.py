@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# coding=utf8
+
+import copy
+import os
+import tarfile
+import threading
+import time
+
+import logbook
+from setproctitle import setproctitle
+
+from ministryofbackup import FileMeta
+from ministryofbackup.profiling import profiled
+
+log = logbook.Logger(__name__)
+
+
+def volume_id(backup_id, volume, n_volumes):
+    """Return the id under which a volume of a backup is stored. Backups
+    consisting of a single volume keep the plain backup id."""
+    if 1 == n_volumes:
+        return backup_id
+    return '%s.vol%d' % (backup_id, volume)
+
+
+class SizePartitioner(object):
+    """Assigns files to volumes as they are found, always to the volume with
+    the least data assigned so far.
+
+    :param n: Number of volumes.
+    """
+
+    def __init__(self, n):
+        self.loads = [0] * n
+
+    def assign(self, rel_name, size):
+        """Choose the volume for a file.
+
+        :return: Number of the volume.
+        """
+        i = self.loads.index(min(self.loads))
+        self.loads[i] += size
+        return i
+
+
+class SubtreePartitioner(SizePartitioner):
+    """Keeps every top-level directory inside a single volume. A directory is
+    assigned to the volume with the least data when its first file is found.
+    """
+
+    def __init__(self, n):
+        super(SubtreePartitioner, self).__init__(n)
+        self.subtrees = {}
+
+    def assign(self, rel_name, size):
+        top = rel_name.split(os.sep, 1)[0] if os.sep in rel_name else ''
+        if not top in self.subtrees:
+            self.subtrees[top] = self.loads.index(min(self.loads))
+
+        i = self.subtrees[top]
+        self.loads[i] += size
+        return i
+
+
+PARTITIONERS = {
+    'size': SizePartitioner,
+    'subtree': SubtreePartitioner,
+}
+
+
+class Dispatcher(object):
+    """Hands files to the processes writing the volumes, while the directory
+    is still being scanned. Can be used from several threads.
+
+    :param sources: One queue per volume, as read by :py:func:`write_volume`.
+    :param partitioner: Decides the volume of each file.
+    :param max_bytes: If given, files are deferred to a later run once their
+                      sizes would sum up to more than this. Smaller files
+                      found later may still fill up the remaining space. The
+                      first file is always archived, otherwise it would never
+                      be backed up.
+    :param keep_deferred: If false, deferred files are only reported by
+                          :py:meth:`dispatch`, not collected in ``deferred``.
+
+    Hardlinks follow the first link to their inode: they go into the same
+    volume (where they are stored as tar hardlink entries, without data) or
+    are deferred with it.
+    """
+
+    def __init__(self, sources, partitioner, max_bytes=None,
+                       keep_deferred=True):
+        self.sources = sources
+        self.partitioner = partitioner
+        self.max_bytes = max_bytes
+        self.keep_deferred = keep_deferred
+        self.n_files = 0
+        self.n_bytes = 0
+        self.deferred = []
+        self.lock = threading.Lock()
+
+        # volumes and deferral of files with more than one link
+        self.link_volumes = {}
+        self.deferred_links = set()
+
+    def dispatch(self, rel_name, file_meta, link_to=None):
+        """Queue a file for archiving.
+
+        :param link_to: For hardlinks, the relative name of the first link to
+                        the same inode.
+        :return: ``False`` if the file was deferred, ``None`` for a hardlink
+                 whose first link is not archived in this run (so there is
+                 nothing to archive), ``True`` otherwise.
+        """
+        with self.lock:
+            if link_to is not None:
+                if link_to in self.link_volumes:
+                    self.sources[self.link_volumes[link_to]].put(
+                        (rel_name, file_meta.path)
+                    )
+                    return True
+                if link_to in self.deferred_links:
+                    self._defer(rel_name)
+                    return False
+                return None
+
+            size = file_meta.filesize
+            if self.max_bytes and self.n_files and\
+               self.n_bytes + size > self.max_bytes:
+                self._defer(rel_name)
+                if file_meta.s.st_nlink > 1:
+                    self.deferred_links.add(rel_name)
+                return False
+
+            self.n_files += 1
+            self.n_bytes += size
+            volume = self.partitioner.assign(rel_name, size)
+            self.sources[volume].put((rel_name, file_meta.path))
+            if file_meta.s.st_nlink > 1:
+                self.link_volumes[rel_name] = volume
+
+        return True
+
+    def close(self):
+        """Signal all volumes that no more files are coming."""
+        for source in self.sources:
+            source.put(None)
+
+    def _defer(self, rel_name):
+        if self.keep_deferred:
+            self.deferred.append(rel_name)
+
+
+def add_sparse(archive, tarinfo, fileobj, extents):
+    """Add a file with holes to a tar archive as a GNU sparse member, storing
+    only its data extents. tarfile can read, but not write these.
+
+    :param archive: A :py:class:`tarfile.TarFile` in GNU format.
+    :param tarinfo: The :py:class:`tarfile.TarInfo` of the file.
+    :param fileobj: File object returning the data extents one after the
+                    other.
+    :param extents: A list of ``(offset, length)`` tuples. All but the last
+                    must be whole blocks of 512 bytes long, see
+                    :py:func:`~ministryofbackup.fds.data_extents`.
+    """
+    # GNU tar starts every extent at a block of its own, tarfile right after
+    # the previous one. the same data only works for both if no padding is
+    # needed in between
+    assert all(0 == length % tarfile.BLOCKSIZE
+               for offset, length in extents[:-1]),\
+           'Extents of %s not aligned to blocks' % tarinfo.name
+
+    # like GNU tar, mark the end of files ending in a hole
+    sparse_map = list(extents)
+    if not sparse_map or sum(sparse_map[-1]) < tarinfo.size:
+        sparse_map.append((tarinfo.size, 0))
+
+    def entries(structs):
+        return ''.join(tarfile.itn(offset, 12, tarfile.GNU_FORMAT) +
+                       tarfile.itn(length, 12, tarfile.GNU_FORMAT)
+                       for offset, length in structs)
+
+    tarinfo = copy.copy(tarinfo)
+    realsize = tarinfo.size
+    tarinfo.type = tarfile.GNUTYPE_SPARSE
+    tarinfo.size = sum(length for offset, length in extents)
+    buf = tarinfo.tobuf(tarfile.GNU_FORMAT, archive.encoding, archive.errors)
+
+    # the first four entries, the extension flag and the real size go into
+    # the unused prefix field of the header, the rest into extension headers
+    # of 21 entries each
+    rest = [sparse_map[i:i+21] for i in xrange(4, len(sparse_map), 21)]
+    header = buf[-tarfile.BLOCKSIZE:]
+    header = header[:386] + entries(sparse_map[:4]).ljust(96, tarfile.NUL) +\
+             chr(1 if rest else 0) +\
+             tarfile.itn(realsize, 12, tarfile.GNU_FORMAT) + header[495:]
+    chksum = tarfile.calc_chksums(header)[0]
+    header = header[:148] + '%06o\0' % chksum + header[155:]
+    buf = buf[:-tarfile.BLOCKSIZE] + header
+
+    for i, structs in enumerate(rest):
+        buf += (entries(structs).ljust(504, tarfile.NUL) +
+                chr(1 if i < len(rest) - 1 else 0)).ljust(tarfile.BLOCKSIZE,
+                                                          tarfile.NUL)
+
+    # the same as TarFile.addfile does
+    archive.fileobj.write(buf)
+    archive.offset += len(buf)
+
+    tarfile.copyfileobj(fileobj, archive.fileobj, tarinfo.size)
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        archive.fileobj.write(tarfile.NUL *
+                              (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    archive.offset += blocks * tarfile.BLOCKSIZE
+    archive.members.append(tarinfo)
+
+
+@profiled('write_volume')
+def write_volume(fd, volume, source, results, deadline=None):
+    """Write a tar archive of files to a file descriptor.
+
+    Runs in its own process, one for every volume. Files are taken from
+    ``source`` until ``None`` is received. For every file, a tuple of
+    ``(volume, rel_name, content_print, link_target)`` is put onto
+    ``results``, the content print being calculated while archiving the file.
+    Further links to an inode already in the archive are stored as tar
+    hardlinks, ``link_target`` is the name of the link they refer to (and
+    ``None`` for all other files). Files with holes are stored as sparse
+    members, holes are neither read nor stored. Once done, ``(volume, None,
+    None, error)`` is sent, ``error`` being ``None`` or a description of the
+    error archiving failed with.
+
+    :param fd: File descriptor to write the archive to.
+    :param volume: Number of the volume.
+    :param source: Queue of ``(rel_name, path)`` tuples.
+    :param results: Queue to report archived files on.
+    :param deadline: If given, files that arrive after this point in time
+                     are not archived, but reported with a content print of
+                     ``None``. The first file is always archived.
+    """
+    setproctitle('mob archive volume %d' % volume)
+    log.debug('Writing volume %d in process %d' % (volume, os.getpid()))
+
+    n_archived = 0
+    link_prints = {}
+    item = True
+    try:
+        with os.fdopen(fd, 'wb') as tar_w,\
+        tarfile.open(mode='w|', fileobj=tar_w) as archive:
+            while True:
+                item = source.get()
+                if item is None:
+                    break
+                rel_name, path = item
+
+                if deadline and n_archived and time.time() > deadline:
+                    results.put((volume, rel_name, None, None))
+                    continue
+
+                fm = FileMeta(path)
+                # tarfile turns further links to an inode it has already
+                # archived into hardlink entries
+                tarinfo = archive.gettarinfo(fm.path, rel_name)
+                if tarinfo.islnk():
+                    archive.addfile(tarinfo)
+                    n_archived += 1
+                    results.put((volume, rel_name,
+                                 link_prints[tarinfo.linkname],
+                                 tarinfo.linkname))
+                    continue
+
+                r = fm.open_read()
+                if r.extents is not None:
+                    add_sparse(archive, tarinfo, r, r.extents)
+                else:
+                    archive.addfile(tarinfo, r)
+
+                # tarinfo reads stats bytes, trigger end-of-file detection
+                assert '' == r.read()
+                r.close()
+
+                n_archived += 1
+                if fm.s.st_nlink > 1:
+                    link_prints[rel_name] = fm.content_print
+                results.put((volume, rel_name, fm.content_print, None))
+    except Exception, e:
+        # the end marker tells the parent, which would wait for it forever
+        # otherwise. a bounded source would keep it waiting for room as well
+        results.put((volume, None, None, str(e) or repr(e)))
+        while item is not None:
+            item = source.get()
+        raise
+
+    log.debug('Volume %d finished, %d files' % (volume, n_archived))
+    results.put((volume, None, None, None))